@@ -2,8 +2,10 @@ import dataiku
 import pandas
 from dataiku.customrecipe import get_output_names_for_role
 from dataiku.customrecipe import get_recipe_config
-from office365_commons import get_credentials_from_config
-from office365_client import Office365Session
+from office365_commons import get_credentials_from_config, BoundedThreadPool, read_local_cache, write_local_cache
+from office365_client import Office365Session, Office365BatchReader
+from office365_drive_index import Office365DriveIndex
+from office365_rate_limiter import get_rate_limiter_metrics
 from datetime import datetime
 from safe_logger import SafeLogger
 from dss_constants import DSSConstants
@@ -12,6 +14,7 @@ from dss_constants import DSSConstants
 logger = SafeLogger("office-365 plugin", DSSConstants.SECRET_PARAMETERS_KEYS)
 
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+SYNC_RESULTS_CACHE = "sync-locally-results"
 
 
 def reorder_permissions(permissions):
@@ -56,14 +59,26 @@ def reorder_permissions(permissions):
     return owners_emails, reads_emails, writes_emails, owners_ids, reads_ids, writes_ids
 
 
-def get_last_modified(paths_details, file_path):
-    # extracts the last modified date of the file_path file
-    # from the paths_details dic
-    for path_detail in paths_details:
-        full_path = path_detail.get("fullPath").strip("/")
-        is_directory = path_detail.get("directory")
-        if not is_directory and file_path == full_path:
-            return path_detail.get("lastModified")
+def load_local_last_modified(folder):
+    # Lists the local folder once, one call per directory, into a {path: last modified} dict
+    local_last_modified = {}
+    directories_to_list = ["/"]
+    while directories_to_list:
+        directory = directories_to_list.pop()
+        folder_details = folder.get_path_details(path=directory)
+        for path_detail in folder_details.get("children", []):
+            full_path = path_detail.get("fullPath")
+            if path_detail.get("directory"):
+                directories_to_list.append(full_path)
+            else:
+                local_last_modified[full_path.strip("/")] = path_detail.get("lastModified")
+    return local_last_modified
+
+
+def is_in_sync_root(file_path, sync_root_path):
+    if not sync_root_path:
+        return True
+    return file_path.startswith(sync_root_path + "/")
 
 
 def sharepoint_date_to_epoch(date):
@@ -79,43 +94,75 @@ def build_file_path(path_elements, file_name):
     return "/".join(path_elements + [file_name])
 
 
-def process_folder(sharepoint_path):
-    logger.info("Processing folder '{}'".format(sharepoint_path))
-    item = sharepoint_drive.get_item(sharepoint_path)
-    results = []
-    for item in sharepoint_drive.get_next_child(sharepoint_path):
-        sub_item_name = item.get("name")
-        next_path = "/".join([sharepoint_path, sub_item_name])
-        if "folder" in item:
-            logger.info("'{}' is a folder, recursing...".format(sharepoint_path))
-            try:
-                results += process_folder(next_path)
-            except Exception as error:
-                logger.error("Error {}".format(error))
+def download_file(item_id, file_path):
+    try:
+        # Download URLs are pre-signed and short lived, so they are fetched just before the download
+        # rather than taken from the delta response, which can be hours old on a large first sync
+        download_url = sharepoint_drive.get_item_by_id(item_id).get("@microsoft.graph.downloadUrl")
+        if not download_url:
+            raise Exception("No download URL for item {}".format(item_id))
+        with files_folders[0].get_writer(file_path) as local_file_handle:
+            sharepoint_drive.read_file_content(download_url, local_file_handle)
+    except Exception as error:
+        logger.error("Error while downloading '{}': {}".format(file_path, error))
+        download_errors.append(file_path)
+        # The partial file would look up to date on the next run, so it is removed
+        try:
+            files_folders[0].delete_path(file_path)
+        except Exception as delete_error:
+            logger.error("Could not remove partial file '{}': {}".format(file_path, delete_error))
+
+
+def get_file_result(file_path, item):
+    # Permissions are filled in later, when the batched permission request returns
+    result = {}
+    result["path"] = file_path
+    result["details"] = item
+    permission_reader.get(
+        url=sharepoint_drive.get_permission_list_url(item.get("id")),
+        callback=lambda response: set_permissions(result, response)
+    )
+    return result
+
+
+def set_permissions(result, response):
+    if int(response.get("status", 200)) >= 400:
+        # Left without permissions, so that they are requested again on the next run
+        logger.error("Could not get permissions for '{}': {}".format(result.get("path"), response.get("body")))
+        return
+    permissions = response.get("body", {}).get("value") or []
+    result["permissions"] = permissions
+    result["owner_email"], result["read_email"], result["write_email"], result["owner_id"], result["read_id"], result["write_id"] = reorder_permissions(permissions)
+
+
+def sync_folder(sync_root_id, sync_root_path):
+    changed_items = {}
+    for changed_item in drive_index.sync(save=False):
+        changed_items[changed_item.get("id")] = changed_item
+    local_last_modified = load_local_last_modified(files_folders[0])
+    previous_results = read_local_cache(SYNC_RESULTS_CACHE, sync_cache_key) or {}
+    results = {}
+    for file_path, indexed_item in drive_index.get_next_file(sync_root_id, folder_path=sync_root_path):
+        item_id = indexed_item.get("id")
+        changed_item = changed_items.get(item_id)
+        if changed_item or "permissions" not in (previous_results.get(file_path) or {}):
+            item = changed_item or sharepoint_drive.get_item_by_id(item_id)
+            results[file_path] = get_file_result(file_path, item)
         else:
-            result = {}
-            download_url = item.get("@microsoft.graph.downloadUrl")
-            folder_details = files_folders[0].get_path_details(path=sharepoint_path)
-            paths_details = folder_details.get("children", [])
-            local_last_modified = get_last_modified(paths_details, next_path)
-            remote_last_modifider = sharepoint_date_to_epoch(item.get("lastModifiedDateTime"))
-            result["path"] = next_path
-            result["details"] = item
-            if download_url:
-                item_id = item.get("id")
-                list = sharepoint_drive.get_permission_list(item_id)
-                result["permissions"] = list.get("value")
-                result["owner_email"], result["read_email"], result["write_email"], result["owner_id"], result["read_id"], result["write_id"] = reorder_permissions(list.get("value"))
-            if download_url and (not local_last_modified or local_last_modified < remote_last_modifider):
-                logger.info("'{}' has been modified since last sync ({} / {}) -> downloading".format(
-                    next_path, local_last_modified, remote_last_modifider
-                ))
-                response = session.get(url=download_url)
-                with files_folders[0].get_writer(next_path) as local_file_handle:
-                    local_file_handle.write(response.content)
-            else:
-                logger.info("'{}' already downloaded, skipping".format(next_path))
-            results.append(result)
+            results[file_path] = previous_results.get(file_path)
+        local_file_last_modified = local_last_modified.get(file_path)
+        remote_last_modified = sharepoint_date_to_epoch(indexed_item.get("last_modified"))
+        if not local_file_last_modified or local_file_last_modified < remote_last_modified:
+            logger.info("'{}' has been modified since last sync ({} / {}) -> downloading".format(
+                file_path, local_file_last_modified, remote_last_modified
+            ))
+            download_pool.submit(download_file, item_id, file_path)
+    permission_reader.flush()
+    for file_path in local_last_modified:
+        if is_in_sync_root(file_path, sync_root_path) and file_path not in results:
+            logger.info("'{}' was removed from SharePoint -> deleting".format(file_path))
+            files_folders[0].delete_path(file_path)
+    logger.info("{} file(s) synced, {} changed on SharePoint".format(len(results), len(changed_items)))
     return results
 
 
@@ -125,24 +172,43 @@ file_security_datasets = [dataiku.Dataset(name) for name in file_security_names]
 files_folder_names = get_output_names_for_role('files_folder')
 files_folders = [dataiku.Folder(name) for name in files_folder_names]
 
-target_folder_paths = files_folders[0].list_paths_in_partition()
-folder_details = files_folders[0].get_path_details()
-# paths_details = folder_details.get("children", [])
-
 config = get_recipe_config()
 auth_token = get_credentials_from_config(config)
 
 sharepoint_path = config.get("sharepoint_path", "/")
 sharepoint_drive_id = config.get("sharepoint_drive_id")
+download_workers = int(config.get("download_workers") or DSSConstants.DEFAULT_DOWNLOAD_WORKERS)
 
-session = Office365Session(auth_token)
+# The connection pool is shared by the download workers and the main thread
+session = Office365Session(auth_token, pool_size=download_workers + 1)
 sharepoint_drive = session.get_drive(sharepoint_drive_id)
 
-item = sharepoint_drive.get_item(sharepoint_path)
-results = []
-
-results = process_folder(sharepoint_path)
-
-odf = pandas.DataFrame(results)
+sync_root = sharepoint_drive.get_item(sharepoint_path, select=["id"])
+if not sync_root:
+    raise Exception("Path '{}' could not be found on the drive".format(sharepoint_path))
+
+# The delta link and the last results are kept per output folder, so that the next run only processes changes
+sync_cache_key = "{}:{}:{}".format(files_folders[0].get_id(), sharepoint_drive_id, sharepoint_path)
+drive_index = Office365DriveIndex(sharepoint_drive, cache_key=sync_cache_key)
+permission_reader = Office365BatchReader(session)
+
+download_errors = []
+download_pool = BoundedThreadPool(max_workers=download_workers)
+try:
+    results = sync_folder(sync_root.get("id"), sharepoint_path.strip("/"))
+finally:
+    download_pool.shutdown(wait=True)
+# The delta link is only saved once every change has been processed, as the next run would not see them again.
+# Files that failed to download were removed locally, so they are downloaded again anyway.
+write_local_cache(SYNC_RESULTS_CACHE, sync_cache_key, results)
+drive_index.save()
+if download_errors:
+    logger.error("{} file(s) could not be downloaded: {}".format(len(download_errors), download_errors))
+logger.info("Rate limiters: {}".format(get_rate_limiter_metrics()))
+
+odf = pandas.DataFrame(list(results.values()))
 output = file_security_datasets[0]
 output.write_with_schema(odf)
+
+if download_errors:
+    raise Exception("{} file(s) could not be downloaded: {}".format(len(download_errors), download_errors))
@@ -1,8 +1,16 @@
 from dataiku.connector import Connector
-from office365_commons import RecordsLimit, get_credentials_from_config, LookupList
-from office365_client import Office365Session, Office365ListWriter
+from office365_commons import RecordsLimit, get_credentials_from_config, LookupList, read_local_cache, write_local_cache
+from office365_commons import get_prefetch_depth
+from office365_client import Office365Session, Office365ListWriter, Office365ListUpsertWriter
+from office365_list_partitioning import Office365ListPartitioning
+from office365_row_mapper import Office365ReadRowMapper
+from office365_lookup_resolver import Office365LookupResolver
 from safe_logger import SafeLogger
 from dss_constants import DSSConstants
+from sharepoint_constants import SharePointConstants
+import hashlib
+import itertools
+import json
 
 
 logger = SafeLogger("office-365 plugin", DSSConstants.SECRET_PARAMETERS_KEYS)
@@ -21,7 +29,14 @@ class Office365ListConnector(Connector):
         self.sharepoint_list_id = config.get("sharepoint_list_id")
         if not self.sharepoint_site_id:
             raise Exception("A SharePoint site must be selected")
-        session = Office365Session(access_token=self.auth_token)
+        self.write_batch_size = int(config.get("write_batch_size") or DSSConstants.MAX_BATCH_SIZE)
+        self.write_concurrency = int(config.get("write_concurrency") or DSSConstants.DEFAULT_WRITE_CONCURRENCY)
+        self.write_strategy = config.get("write_strategy", "replace")
+        self.upsert_key_column = config.get("upsert_key_column")
+        if self.write_strategy == "upsert" and not self.upsert_key_column:
+            raise Exception("A key column must be set to upsert rows")
+        # The connection pool is shared by the batches sent in parallel
+        session = Office365Session(access_token=self.auth_token, pool_size=self.write_concurrency + 1)
 
         if self.sharepoint_site_id == "dku_manual_select":
             sharepoint_site_overwrite = config.get("sharepoint_site_overwrite")
@@ -38,6 +53,19 @@ class Office365ListConnector(Connector):
 
         self.list = site.get_list(self.sharepoint_list_id)
         self.must_see_columns = config.get("must_see_columns", [])
+        self.filter_query = config.get("filter_query")
+        self.order_by = config.get("order_by")
+        self.allow_non_indexed_queries = config.get("allow_non_indexed_queries", False)
+        self.read_mode = config.get("read_mode", "full")
+        self.delta_state_key = config.get("delta_state_key") or ""
+        self.prefetch_depth = get_prefetch_depth(config)
+        self.expand_lookups = config.get("expand_lookups", True)
+        self.partitioning = Office365ListPartitioning(
+            config.get("partitioning_mode", "none"),
+            column=config.get("partitioning_column"),
+            period=config.get("partitioning_period"),
+            id_range_size=config.get("id_range_size")
+        )
 
     def get_read_schema(self):
         """
@@ -59,50 +87,127 @@ class Office365ListConnector(Connector):
         Supported types are: string, int, bigint, float, double, date, boolean
         """
 
-        # In this example, we don't specify a schema here, so DSS will infer the schema
-        # from the columns actually returned by the generate_rows method
-        return None
+        lookup_list = self.get_lookup_list()
+        select_list = lookup_list.get_select()
+        if not select_list:
+            # All the fields are read, so DSS infers the schema from the rows
+            return None
+        read_schema = self.list.get_schema().get_read_schema(select_list.split(","))
+        if self.read_mode == "changes":
+            read_schema.get("columns").append({"name": "dku_change_type", "type": "string"})
+        return read_schema
 
-    def generate_rows(self, dataset_schema=None, dataset_partitioning=None,
-                      partition_id=None, records_limit=-1):
-        limit = RecordsLimit(records_limit)
-        column_display_name = {}
+    def get_lookup_list(self):
         lookup_list = LookupList(must_see_columns=self.must_see_columns)
         for column in self.list.get_columns():
-            column_display_name[column.get("name")] = column.get("displayName")
             lookup_list.append(column)
-        # Special case for the id column, because, why not...
-        column_display_name["id"] = "ID"
-        for row in self.list.get_next_row(
-            select_list=lookup_list.get_select(),
-        ):
-            fields = row.get("fields", {})
-            row_with_real_names = {}
-            for name in fields:
-                selected_column_display_name = column_display_name.get(name)
-                if selected_column_display_name:
-                    row_with_real_names[selected_column_display_name] = fields.get(name)
-            yield row_with_real_names
+        return lookup_list
+
+    def generate_rows(self, dataset_schema=None, dataset_partitioning=None,
+                      partition_id=None, records_limit=-1):
+        limit = RecordsLimit(records_limit)
+        lookup_list = self.get_lookup_list()
+        row_mapper = Office365ReadRowMapper(self.list.get_columns())
+        lookup_resolver = None
+        if self.expand_lookups:
+            lookup_resolver = Office365LookupResolver(self.list, lookup_list.get_lookup_columns())
+            if not lookup_resolver.has_targets():
+                lookup_resolver = None
+        if self.read_mode in ["changes", "snapshot"]:
+            rows = self.get_next_row_from_delta(lookup_list.get_select(), row_mapper, records_limit, lookup_resolver=lookup_resolver)
+        else:
+            rows = self.get_next_row(
+                lookup_list.get_select(), row_mapper, records_limit,
+                partition_id=partition_id, lookup_resolver=lookup_resolver
+            )
+        for row in rows:
+            yield row
             if limit.is_reached():
                 return
 
+    def get_next_row(self, select_list, row_mapper, records_limit, partition_id=None, lookup_resolver=None):
+        top = DSSConstants.MAX_PAGE_SIZE
+        if records_limit > 0:
+            top = min(records_limit, top)
+        filter_query = self.filter_query
+        if partition_id and self.partitioning.is_enabled():
+            partition_filter = self.partitioning.get_filter(partition_id)
+            filter_query = "({}) and ({})".format(filter_query, partition_filter) if filter_query else partition_filter
+        rows = self.list.get_next_row(
+            select_list=select_list,
+            filter_query=filter_query,
+            order_by=self.order_by,
+            top=top,
+            allow_non_indexed_queries=self.allow_non_indexed_queries,
+            prefetch_depth=self.prefetch_depth
+        )
+        if not lookup_resolver:
+            for row in rows:
+                yield row_mapper.map_row(row)
+            return
+        # Lookup ids are resolved for a whole page of rows at once
+        while True:
+            page_rows = list(itertools.islice(rows, top))
+            if not page_rows:
+                return
+            for row in lookup_resolver.resolve(page_rows):
+                yield row_mapper.map_row(row)
+
+    def get_next_row_from_delta(self, select_list, row_mapper, records_limit, lookup_resolver=None):
+        # "changes" returns the rows changed or deleted since the last complete build.
+        # "snapshot" merges these changes into a local copy of the list and returns all of it.
+        # The delta link is only saved after a complete read, so previews do not consume changes.
+        # The state is kept per dataset, and starts over when the selected columns or the lookup setting change,
+        # as the rows already in the snapshot would otherwise keep their previous columns and values
+        cache_key = ":".join([
+            self.read_mode, self.sharepoint_site_id, self.sharepoint_list_id, self.delta_state_key,
+            get_read_settings_hash(select_list, self.expand_lookups)
+        ])
+        state = read_local_cache(SharePointConstants.LIST_DELTA_CACHE, cache_key) or {}
+        delta_link = state.get("delta_link")
+        snapshot_rows = state.get("rows", {})
+        pages = self.list.get_next_delta_page(delta_link=delta_link, select_list=select_list, prefetch_depth=self.prefetch_depth)
+        try:
+            first_page = next(pages, None)
+        except Exception as error:
+            if not delta_link:
+                raise
+            logger.warning("Could not use the delta link ({}), reading the whole list".format(error))
+            snapshot_rows = {}
+            pages = self.list.get_next_delta_page(select_list=select_list, prefetch_depth=self.prefetch_depth)
+            first_page = next(pages, None)
+        for page in itertools.chain([first_page] if first_page else [], pages):
+            if lookup_resolver:
+                lookup_resolver.resolve([row for row in page.get("value", []) if "deleted" not in row])
+            for row in page.get("value", []):
+                row_id = row.get("id")
+                if "deleted" in row:
+                    snapshot_rows.pop(row_id, None)
+                    row_with_real_names = {"ID": row_id, "dku_change_type": "deleted"}
+                else:
+                    row_with_real_names = row_mapper.map_row(row)
+                    snapshot_rows[row_id] = row_with_real_names
+                    row_with_real_names = dict(row_with_real_names, dku_change_type="upserted")
+                if self.read_mode == "changes":
+                    yield row_with_real_names
+            delta_link = page.get("@odata.deltaLink") or delta_link
+        if self.read_mode == "snapshot":
+            for row_with_real_names in snapshot_rows.values():
+                yield row_with_real_names
+        if records_limit < 0:
+            new_state = {"delta_link": delta_link}
+            if self.read_mode == "snapshot":
+                new_state["rows"] = snapshot_rows
+            write_local_cache(SharePointConstants.LIST_DELTA_CACHE, cache_key, new_state)
+
     def get_writer(self, dataset_schema=None, dataset_partitioning=None,
                    partition_id=None, write_mode='OVERWRITE'):
         logger.info("get_writer caleed in {} mode".format(write_mode))
-        if write_mode == 'OVERWRITE':
-            self.list.delete_all_rows()
-        sharepoint_columns = []
-        for sharepoint_column in self.list.get_columns():
-            sharepoint_columns.append(
-                {
-                    "name": sharepoint_column.get("name"),
-                    "display_name": sharepoint_column.get("displayName"),
-                    "type": sharepoint_to_dss_type(sharepoint_column)
-                }
-            )
+        if write_mode == 'OVERWRITE' and self.write_strategy != "upsert":
+            self.list.delete_all_rows(concurrency=self.write_concurrency)
         missing_sharepoint_columns = compute_missing_sharepoint_columns(
             dataset_schema.get("columns"),
-            sharepoint_columns
+            self.list.get_schema()
         )
         for missing_sharepoint_column in missing_sharepoint_columns:
             logger.info("Adding column '{}' of type {}".format(
@@ -114,20 +219,34 @@ class Office365ListConnector(Connector):
                 missing_sharepoint_column.get("type"),
                 description="Created by DSS Office-365 plugin"
             )
+        if self.write_strategy == "upsert":
+            # In overwrite mode, the items whose key is not in the dataset anymore are deleted
+            return Office365ListUpsertWriter(
+                self.list, dataset_schema, self.upsert_key_column,
+                delete_missing=(write_mode == 'OVERWRITE'),
+                batch_size=self.write_batch_size,
+                concurrency=self.write_concurrency
+            )
         return Office365ListWriter(
-            self.list, dataset_schema
+            self.list, dataset_schema,
+            batch_size=self.write_batch_size,
+            concurrency=self.write_concurrency
         )
 
     def get_partitioning(self):
         """
         Return the partitioning schema that the connector defines.
         """
-        raise NotImplementedError
+        if not self.partitioning.is_enabled():
+            raise NotImplementedError
+        return self.partitioning.get_partitioning()
 
     def list_partitions(self, partitioning):
         """Return the list of partitions for the partitioning scheme
         passed as parameter"""
-        return []
+        if not self.partitioning.is_enabled():
+            return []
+        return self.partitioning.list_partition_ids(self.list, allow_non_indexed_queries=self.allow_non_indexed_queries)
 
     def partition_exists(self, partitioning, partition_id):
         """Return whether the partition passed as parameter exists
@@ -135,7 +254,14 @@ class Office365ListConnector(Connector):
         Implementation is only required if the corresponding flag is set to True
         in the connector definition
         """
-        raise NotImplementedError
+        if not self.partitioning.is_enabled():
+            raise NotImplementedError
+        rows = self.list.get_next_row(
+            filter_query=self.partitioning.get_filter(partition_id),
+            top=1,
+            allow_non_indexed_queries=self.allow_non_indexed_queries
+        )
+        return next(rows, None) is not None
 
     def get_records_count(self, partitioning=None, partition_id=None):
         """
@@ -147,25 +273,12 @@ class Office365ListConnector(Connector):
         raise NotImplementedError
 
 
-def sharepoint_to_dss_type(sharepoint_column):
-    if "text" in sharepoint_column:
-        return "string"
-    if "number" in sharepoint_column:
-        return "float"
-    return "string"
-
-
-def compute_missing_sharepoint_columns(dss_columns, sharepoint_columns):
+def compute_missing_sharepoint_columns(dss_columns, list_schema):
     missing_sharepoint_columns = []
     for dss_column in dss_columns:
         dss_column_name = dss_column.get("name")
         dss_column_type = dss_column.get("type")
-        column_found = False
-        for sharepoint_column in sharepoint_columns:
-            sharepoint_column_name = sharepoint_column.get("name")
-            if sharepoint_column_name == dss_column_name:
-                column_found = True
-        if column_found:
+        if list_schema.has_column(dss_column_name):
             logger.info("Column '{}' found on SharePoint, so skipping creation".format(dss_column_name))
             continue
         else:
@@ -176,3 +289,9 @@ def compute_missing_sharepoint_columns(dss_columns, sharepoint_columns):
                 }
             )
     return missing_sharepoint_columns
+
+
+def get_read_settings_hash(select_list, expand_lookups):
+    selected_columns = sorted((select_list or "").split(","))
+    read_settings = json.dumps({"columns": selected_columns, "expand_lookups": bool(expand_lookups)})
+    return hashlib.sha1(read_settings.encode("utf-8")).hexdigest()
@@ -1,5 +1,5 @@
 from dataiku.connector import Connector
-from office365_commons import RecordsLimit, get_credentials_from_config
+from office365_commons import RecordsLimit, get_credentials_from_config, get_prefetch_depth
 from office365_client import Office365Session
 from safe_logger import SafeLogger
 from dss_constants import DSSConstants
@@ -20,6 +20,7 @@ class Office365MessagesConnector(Connector):
         self.user_principal_name = config.get("user_principal_name")
         self.folder_id = config.get("folder_id")
         search_space = config.get("search_space", "user")
+        self.prefetch_depth = get_prefetch_depth(config)
         if not self.user_principal_name:
             raise Exception("A user principal name must be selected")
         session = Office365Session(access_token=self.auth_token)
@@ -52,7 +53,11 @@ class Office365MessagesConnector(Connector):
     def generate_rows(self, dataset_schema=None, dataset_partitioning=None,
                       partition_id=None, records_limit=-1):
         limit = RecordsLimit(records_limit=records_limit)
-        for message in self.messages.get_next_message(user_principal_name=self.user_principal_name, folder_id=self.folder_id):
+        for message in self.messages.get_next_message(
+            user_principal_name=self.user_principal_name,
+            folder_id=self.folder_id,
+            prefetch_depth=self.prefetch_depth
+        ):
             yield message
             if limit.is_reached():
                 return
@@ -1,5 +1,5 @@
 from dataiku.connector import Connector
-from office365_commons import RecordsLimit, get_credentials_from_config
+from office365_commons import RecordsLimit, get_credentials_from_config, get_prefetch_depth
 from office365_client import Office365Session
 from safe_logger import SafeLogger
 from dss_constants import DSSConstants
@@ -19,6 +19,7 @@ class Office365PlannerConnector(Connector):
         auth_token = get_credentials_from_config(config)
         self.session = Office365Session(access_token=auth_token)
         self.plan_id = config.get("plan_id")
+        self.prefetch_depth = get_prefetch_depth(config)
 
     def get_read_schema(self):
         """
@@ -47,7 +48,7 @@ class Office365PlannerConnector(Connector):
     def generate_rows(self, dataset_schema=None, dataset_partitioning=None,
                       partition_id=None, records_limit=-1):
         limit = RecordsLimit(records_limit=records_limit)
-        for task in self.session.get_next_task(self.plan_id):
+        for task in self.session.get_next_task(self.plan_id, prefetch_depth=self.prefetch_depth):
             yield task
             if limit.is_reached():
                 return
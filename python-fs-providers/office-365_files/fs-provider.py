@@ -1,15 +1,14 @@
 from dataiku.fsprovider import FSProvider
 from office365_client import Office365Session
+from office365_drive_index import Office365DriveIndex
+from office365_item_cache import Office365ItemCache
+from office365_rate_limiter import get_rate_limiter_metrics
 from office365_commons import get_credentials_from_config, format_date, get_rel_path, get_lnt_path
 from safe_logger import SafeLogger
 from dss_constants import DSSConstants
+from sharepoint_constants import SharePointConstants
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
-import shutil
-
-try:
-    from BytesIO import BytesIO  # for Python 2
-except ImportError:
-    from io import BytesIO  # for Python 3
 
 
 logger = SafeLogger("office-365 plugin", DSSConstants.SECRET_PARAMETERS_KEYS)
@@ -29,7 +28,10 @@ class Office365FSProvider(FSProvider):
         self.root = root
         self.provider_root = "/"
         auth_token = get_credentials_from_config(config)
-        self.session = Office365Session(auth_token)
+        self.enumeration_workers = int(config.get("enumeration_workers") or DSSConstants.DEFAULT_ENUMERATION_WORKERS)
+        max_depth = config.get("max_depth")
+        self.max_depth = -1 if max_depth is None else int(max_depth)
+        self.session = Office365Session(auth_token, pool_size=self.enumeration_workers + 1)
         self.sharepoint_drive_id = config.get("sharepoint_drive_id")
         if self.sharepoint_drive_id == "dku_manual_select":
             self.sharepoint_site_id = config.get("sharepoint_site_id")
@@ -40,17 +42,29 @@ class Office365FSProvider(FSProvider):
             sharepoint_root_overwrite = config.get("sharepoint_root_overwrite")
             self.sharepoint_drive_id = site.get_drive_id(sharepoint_root_overwrite)
         self.sharepoint_drive = self.session.get_drive(self.sharepoint_drive_id)
+        self.enumeration_mode = config.get("enumeration_mode", "children")
+        self.item_cache = Office365ItemCache()
 
     def get_full_path(self, path):
         path_elts = [self.provider_root, get_rel_path(self.root), get_rel_path(path)]
         path_elts = [e for e in path_elts if len(e) > 0]
         return os.path.join(*path_elts)
 
+    def get_item(self, full_path):
+        item = self.item_cache.get(full_path)
+        if item is None:
+            item = self.sharepoint_drive.get_item(full_path, select=SharePointConstants.DRIVE_ITEM_FIELDS)
+            if "error" not in item:
+                self.item_cache.put(full_path, item)
+        return item
+
     def close(self):
         """
         Perform any necessary cleanup
         """
         logger.info('close')
+        logger.info("Rate limiters: {}".format(get_rate_limiter_metrics()))
+        logger.info("Item cache: {}".format(self.item_cache.get_metrics()))
 
     def stat(self, path):
         """
@@ -60,7 +74,7 @@ class Office365FSProvider(FSProvider):
         full_path = self.get_full_path(path)
         logger.info("stat:path={}, full_path={}".format(path, full_path))
         target_path = full_path if len(full_path) < 2 else full_path.strip("/")
-        item = self.sharepoint_drive.get_item(target_path)
+        item = self.get_item(target_path)
         if not item:
             logger.info("stat:Item {} not found".format(path))
             return None
@@ -90,7 +104,7 @@ class Office365FSProvider(FSProvider):
         full_path = get_lnt_path(self.get_full_path(path))
         logger.info("browse:path={}, full_path={}".format(path, full_path))
 
-        item = self.sharepoint_drive.get_item(full_path)
+        item = self.get_item(full_path)
 
         if not item:
             logger.info("Item {} not found".format(path))
@@ -107,7 +121,13 @@ class Office365FSProvider(FSProvider):
                 'lastModified': int(format_date(item.get("lastModifiedDateTime"))) if item.get("lastModifiedDateTime") else None
             }
         children = []
-        for item in self.sharepoint_drive.get_next_child(full_path):
+        child_items = list(self.sharepoint_drive.get_next_child(
+            full_path,
+            select=SharePointConstants.DRIVE_ITEM_FIELDS,
+            prefetch_depth=DSSConstants.DEFAULT_PREFETCH_DEPTH
+        ))
+        self.item_cache.put_children(full_path, child_items)
+        for item in child_items:
             if "folder" in item:
                 children.append(
                     {
@@ -134,7 +154,7 @@ class Office365FSProvider(FSProvider):
         """
         full_path = self.get_full_path(path)
         logger.info("enumerate:path={}, full_path={}".format(path, full_path))
-        item = self.sharepoint_drive.get_item(full_path)
+        item = self.get_item(full_path)
         if not item:
             logger.info("Item {} not found".format(path))
             return None
@@ -143,30 +163,64 @@ class Office365FSProvider(FSProvider):
                 'path': get_lnt_path(path)
             }]
         folder_id = item.get("id")
-        ret = self.list_recursive(path, full_path, folder_id, first_non_empty)
-        return ret
+        # The walks are generators, so that first_non_empty stops them early, but DSS expects a list
+        if self.enumeration_mode == "delta":
+            return list(self.list_from_drive_index(path, folder_id, first_non_empty))
+        return list(self.list_recursive(path, full_path, folder_id, first_non_empty))
+
+    def list_from_drive_index(self, path, folder_id, first_non_empty):
+        drive_index = Office365DriveIndex(self.sharepoint_drive)
+        drive_index.sync()
+        for file_path, item in drive_index.get_next_file(folder_id):
+            if self.max_depth >= 0 and file_path.count("/") > self.max_depth:
+                continue
+            yield {
+                "path": get_lnt_path(os.path.join(path, file_path)),
+                "lastModified": int(format_date(item.get("last_modified"))) if item.get("last_modified") else None,
+                "size": item.get("size")
+            }
+            if first_non_empty:
+                return
 
     def list_recursive(self, path, full_path, folder_id, first_non_empty):
-        paths = []
-        for item in self.sharepoint_drive.get_next_child_by_id(folder_id):
-            if "folder" in item:
-                paths.extend(
-                    self.list_recursive(
-                        get_lnt_path(os.path.join(path, item.get("name"))),
-                        get_lnt_path(os.path.join(full_path, item.get("name"))),
-                        item.get("id"),
-                        first_non_empty
-                    )
-                )
-            else:
-                paths.append({
-                    "path": get_lnt_path(os.path.join(path, item.get("name"))),
-                    "lastModified": int(format_date(item.get("lastModifiedDateTime"))) if item.get("lastModifiedDateTime") else None,
-                    "size": item.get("size")
-                })
-                if first_non_empty:
-                    return paths
-        return paths
+        # Breadth first walk: folders are listed in parallel by the worker pool,
+        # and files are yielded as soon as their folder has been listed
+        executor = ThreadPoolExecutor(max_workers=self.enumeration_workers)
+        pending_folders = {
+            executor.submit(self.get_children, folder_id, path): (path, 0)
+        }
+        try:
+            while pending_folders:
+                listed_folders, _ = wait(pending_folders, return_when=FIRST_COMPLETED)
+                for listed_folder in listed_folders:
+                    folder_path, depth = pending_folders.pop(listed_folder)
+                    child_items = listed_folder.result()
+                    for item in child_items:
+                        item_path = get_lnt_path(os.path.join(folder_path, item.get("name")))
+                        if "folder" in item:
+                            if self.max_depth < 0 or depth < self.max_depth:
+                                pending_folders[executor.submit(self.get_children, item.get("id"), item_path)] = (item_path, depth + 1)
+                        else:
+                            yield {
+                                "path": item_path,
+                                "lastModified": int(format_date(item.get("lastModifiedDateTime"))) if item.get("lastModifiedDateTime") else None,
+                                "size": item.get("size")
+                            }
+                            if first_non_empty:
+                                return
+        finally:
+            # Stops the walk when a file was found or a listing failed
+            for pending_folder in pending_folders:
+                pending_folder.cancel()
+            executor.shutdown(wait=False)
+
+    def get_children(self, folder_id, folder_path):
+        # Folders listed by a previous enumeration or browse are served from the cache, by id
+        child_items = self.item_cache.get_children_by_id(folder_id)
+        if child_items is None:
+            child_items = list(self.sharepoint_drive.get_next_child_by_id(folder_id, select=SharePointConstants.DRIVE_ITEM_FIELDS))
+            self.item_cache.put_children(self.get_full_path(folder_path), child_items)
+        return child_items
 
     def delete_recursive(self, path):
         """
@@ -175,10 +229,11 @@ class Office365FSProvider(FSProvider):
         full_path = self.get_full_path(path)
         logger.info("delete_recursive:path={}, full_path={}".format(path, full_path))
 
-        item = self.sharepoint_drive.get_item(full_path)
+        item = self.get_item(full_path)
         item_id = item.get("id")
         number_deleted_items = 1 if "folder" not in item else int(item.get("folder", {}).get("childCount", 1))+1
         self.sharepoint_drive.delete_item_by_id(item_id)
+        self.item_cache.invalidate(full_path)
         return number_deleted_items
 
     def move(self, from_path, to_path):
@@ -190,6 +245,8 @@ class Office365FSProvider(FSProvider):
 
         logger.info("move:full_from_path={}, full_to_path={}".format(full_from_file_path, full_to_file_path))
         json_response = self.sharepoint_drive.move_item(full_from_file_path, full_to_file_path)
+        self.item_cache.invalidate(full_from_file_path)
+        self.item_cache.invalidate(full_to_file_path)
         if "id" in json_response:
             return True
         return False
@@ -201,11 +258,11 @@ class Office365FSProvider(FSProvider):
         full_path = self.get_full_path(path)
         logger.info("read:full_path={}".format(full_path))
         target_path = full_path if len(full_path) < 2 else full_path.strip("/")
-        item = self.sharepoint_drive.get_item(target_path)
+        item = self.get_item(target_path)
         download_url = item.get("@microsoft.graph.downloadUrl")
-        response = self.session.get(url=download_url)
-        bio = BytesIO(response.content)
-        shutil.copyfileobj(bio, stream)
+        if not download_url:
+            raise Exception("Path '{}' is not a file or could not be found".format(path))
+        self.sharepoint_drive.read_file_content(download_url, stream, limit=limit)
 
     def write(self, path, stream):
         """
@@ -215,17 +272,8 @@ class Office365FSProvider(FSProvider):
         full_path_parent = os.path.dirname(full_path)
         logger.info("write:path={}, full_path={}".format(path, full_path))
 
-        parent_item = self.sharepoint_drive.get_item(full_path_parent)
+        parent_item = self.get_item(full_path_parent)
         parent_id = parent_item.get("id")
 
-        json_response = self.sharepoint_drive.create_empty_item(parent_id, path)
-        item_id = json_response.get("id")
-
-        json_response = self.sharepoint_drive.create_upload_session(item_id)
-        upload_url = json_response.get("uploadUrl")
-        bio = BytesIO()
-        shutil.copyfileobj(stream, bio)
-        bio.seek(0)
-        data = bio.read()
-
-        self.sharepoint_drive.write_chunked_file_content(upload_url, data)
+        self.sharepoint_drive.upload_file(parent_id, path, stream)
+        self.item_cache.invalidate(full_path)
@@ -7,6 +7,13 @@ class DSSConstants(object):
     CHILDREN = 'children'
     DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
     DEFAULT_BATCH_SIZE = 19
+    DEFAULT_DOWNLOAD_WORKERS = 4
+    DEFAULT_ENUMERATION_WORKERS = 8
+    DEFAULT_ID_RANGE_SIZE = 10000
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_PREFETCH_DEPTH = 2
+    DEFAULT_RETRY_AFTER = 30
+    DEFAULT_WRITE_CONCURRENCY = 4
     DIRECTORY = 'directory'
     EXISTS = 'exists'
     FALLBACK_TYPE = "string"
@@ -16,6 +23,8 @@ class DSSConstants(object):
         "Accept-Encoding": "gzip"
     }
     IS_DIRECTORY = 'isDirectory'
+    ITEM_CACHE_MAX_SIZE = 10000
+    ITEM_CACHE_TIME_TO_LIVE = 60
     JSON_HEADERS = {
         "Content-Type": APPLICATION_JSON,
         "Accept": APPLICATION_JSON
@@ -27,13 +36,28 @@ class DSSConstants(object):
         "sharepoint_username": "The account's username is missing",
         "sharepoint_password": "The account's password is missing"
     }
+    MAX_BATCH_RETRIES = 10
+    MAX_PAGE_SIZE = 999
+    MAX_SHARED_SESSIONS = 16
+    MAX_THROTTLING_RETRIES = 10
+    MAX_BATCH_SIZE = 20
     OAUTH_DETAILS = {
         "sharepoint_tenant": "The tenant name is missing",
         "sharepoint_site": "The site name is missing",
         "sharepoint_oauth": "The access token is missing"
     }
+    ODATA_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
     PATH = 'path'
     PLUGIN_VERSION = "0.0.5"
+    POOL_CONNECTIONS = 10
+    PREFETCH_MAX_BUFFERED_SIZE = 67108864
+    RATE_LIMIT_BURST = 10
+    RATE_LIMIT_INCREASE = 0.05
+    RATE_LIMIT_INITIAL_RATE = 10.0
+    RATE_LIMIT_MAX_RATE = 50.0
+    RATE_LIMIT_MIN_RATE = 0.5
+    RATE_LIMIT_THROTTLE_DECREASE = 0.5
+    RATE_LIMIT_WARNING_DECREASE = 0.9
     SECRET_PARAMETERS_KEYS = ["Authorization", "sharepoint_username", "sharepoint_password", "client_secret", "sharepoint_oauth"]
     SITE_APP_DETAILS = {
         "sharepoint_tenant": "The tenant name is missing",
@@ -43,6 +67,9 @@ class DSSConstants(object):
         "client_secret": "The client secret is missing"
     }
     SIZE = 'size'
+    TOKEN_CACHE = "tokens"
+    TOKEN_CACHE_ON_DISK = True
+    TOKEN_REFRESH_MARGIN = 300
     TYPES = {
         "string": "Text",
         "map": "Note",
@@ -56,3 +83,4 @@ class DSSConstants(object):
         "tinyint": "Integer",
         "date": "DateTime"
     }
+    WRITE_REPORT_INTERVAL = 30
@@ -1,4 +1,15 @@
 import requests
+import threading
+import time
+import base64
+import hashlib
+import json
+from office365_commons import read_local_cache, write_local_cache
+from safe_logger import SafeLogger
+from dss_constants import DSSConstants
+
+
+logger = SafeLogger("office-365 plugin", [])
 
 
 class Office365Auth(requests.auth.AuthBase):
@@ -7,6 +18,92 @@ class Office365Auth(requests.auth.AuthBase):
 
     def __call__(self, request):
         request.headers["Authorization"] = "Bearer {}".format(
-            self.access_token
+            token_cache.get_fresh_token(self.access_token)
         )
         return request
+
+
+class Office365TokenCache(object):
+    # Tokens obtained from a keypair, cached per tenant, app id and scope. They are refreshed
+    # TOKEN_REFRESH_MARGIN seconds before they expire, so long jobs never send an expired token.
+    # With a disk_cache_secret, tokens are also shared between processes in an encrypted cache file.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.token_sources = {}
+        self.cache_keys_by_access_token = {}
+
+    def get_token(self, cache_key, acquire_token, disk_cache_secret=None):
+        with self.lock:
+            self.token_sources[cache_key] = (acquire_token, disk_cache_secret)
+            token = self.tokens.get(cache_key)
+            if not is_token_fresh(token):
+                token = read_token_from_disk(cache_key, disk_cache_secret)
+            if not is_token_fresh(token):
+                logger.info("acquiring token")
+                json_response = acquire_token()
+                access_token = json_response.get("access_token")
+                if not access_token:
+                    raise Exception("Could not acquire a token: {}".format(json_response.get("error_description")))
+                token = {
+                    "access_token": access_token,
+                    "expires_on": time.time() + int(json_response.get("expires_in", 0))
+                }
+                write_token_to_disk(cache_key, disk_cache_secret, token)
+            self.tokens[cache_key] = token
+            self.cache_keys_by_access_token[token.get("access_token")] = cache_key
+            return token.get("access_token")
+
+    def get_fresh_token(self, access_token):
+        # Tokens that do not come from this cache (SSO, DSS OAuth connections) are returned as is
+        cache_key = self.cache_keys_by_access_token.get(access_token)
+        if not cache_key:
+            return access_token
+        acquire_token, disk_cache_secret = self.token_sources.get(cache_key)
+        return self.get_token(cache_key, acquire_token, disk_cache_secret=disk_cache_secret)
+
+
+def is_token_fresh(token):
+    if not token:
+        return False
+    return token.get("expires_on", 0) - time.time() > DSSConstants.TOKEN_REFRESH_MARGIN
+
+
+def get_fernet(disk_cache_secret):
+    # cryptography is installed along with msal. Without it, tokens are only cached in memory.
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        return None
+    key = base64.urlsafe_b64encode(hashlib.sha256(disk_cache_secret.encode("utf-8")).digest())
+    return Fernet(key)
+
+
+def read_token_from_disk(cache_key, disk_cache_secret):
+    if not disk_cache_secret:
+        return None
+    fernet = get_fernet(disk_cache_secret)
+    cache = read_local_cache(DSSConstants.TOKEN_CACHE, cache_key)
+    if not fernet or not cache:
+        return None
+    try:
+        return json.loads(fernet.decrypt(cache.get("token", "").encode("utf-8")).decode("utf-8"))
+    except Exception as error:
+        logger.warning("Could not decrypt the cached token: {}".format(error))
+        return None
+
+
+def write_token_to_disk(cache_key, disk_cache_secret, token):
+    if not disk_cache_secret:
+        return
+    fernet = get_fernet(disk_cache_secret)
+    if not fernet:
+        return
+    encrypted_token = fernet.encrypt(json.dumps(token).encode("utf-8")).decode("utf-8")
+    try:
+        write_local_cache(DSSConstants.TOKEN_CACHE, cache_key, {"token": encrypted_token})
+    except Exception as error:
+        logger.warning("Could not write the token cache: {}".format(error))
+
+
+token_cache = Office365TokenCache()
@@ -1,21 +1,63 @@
 import requests
+import threading
 import time
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
 from safe_logger import SafeLogger
 from office365_site import Office365Site
 from office365_drive import Office365Drive
 from office365_messages import Office365Messages
 from office365_auth import Office365Auth
-from office365_commons import get_next_page_url, get_error, prepare_row, is_throttling, get_retry_after_value
+from office365_commons import get_next_page_url, get_error, is_throttling, get_retry_after_value
+from office365_commons import is_quota_nearly_used, get_tenant_id_from_token, BoundedThreadPool, is_multi_valued_lookup
+from office365_rate_limiter import rate_limiter_registry, get_resource_from_url
+from office365_read_ahead import Office365ReadAheadPager
+from office365_row_mapper import Office365WriteRowMapper, get_row_hash, normalize_value
 from dss_constants import DSSConstants
+from sharepoint_constants import SharePointConstants
 
 
 logger = SafeLogger("office-365 plugin", [])
 
 
+class Office365RequestsSessionRegistry(object):
+    # One requests.Session per access token for the whole process, so that all the plugin components
+    # reuse the same keep-alive connections, to Graph as well as to the SharePoint download hosts
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self.pool_sizes = {}
+
+    def get_session(self, access_token, pool_size=None):
+        pool_size = pool_size or DSSConstants.DEFAULT_POOL_SIZE
+        with self.lock:
+            session = self.sessions.get(access_token)
+            if session is None:
+                session = requests.Session()
+                session.auth = Office365Auth(access_token=access_token)
+                self.sessions[access_token] = session
+                self.pool_sizes[access_token] = 0
+                while len(self.sessions) > DSSConstants.MAX_SHARED_SESSIONS:
+                    oldest_access_token, oldest_session = self.sessions.popitem(last=False)
+                    self.pool_sizes.pop(oldest_access_token, None)
+                    oldest_session.close()
+            self.sessions.move_to_end(access_token)
+            if self.pool_sizes.get(access_token) < pool_size:
+                # Grow the pools so that every worker thread can keep its own connection
+                adapter = HTTPAdapter(pool_connections=DSSConstants.POOL_CONNECTIONS, pool_maxsize=pool_size)
+                session.mount("https://", adapter)
+                self.pool_sizes[access_token] = pool_size
+            return session
+
+
+requests_session_registry = Office365RequestsSessionRegistry()
+
+
 class Office365Session():
-    def __init__(self, access_token=None):
-        self.session = requests.Session()
-        self.session.auth = Office365Auth(access_token=access_token)
+    def __init__(self, access_token=None, endpoint_url=None, pool_size=None):
+        self.session = requests_session_registry.get_session(access_token, pool_size=pool_size)
+        self.endpoint_url = endpoint_url
+        self.tenant_id = get_tenant_id_from_token(access_token)
         self.is_batch_mode = False
         self.requests_buffer = []
         self.batch_size = 0
@@ -30,18 +72,32 @@ class Office365Session():
             if len(self.requests_buffer) >= self.batch_size:
                 self.flush()
             return
+        # Only meaningful in batch mode
+        kwargs.pop("batch_id", None)
+        kwargs.pop("depends_on", None)
 
+        rate_limiter = self.get_rate_limiter(kwargs.get("url"))
+        number_of_retries = 0
         should_retry = True
         while should_retry:
             should_retry = False
+            rate_limiter.acquire()
             response = self.session.request(**kwargs)
             if is_throttling(response):
                 retry_after = get_retry_after_value(response)
-                if retry_after:
-                    logger.warning("SharePoint is throttling... Sleeping for {} seconds".format(retry_after))
-                    time.sleep(retry_after)
-                    should_retry = True
-                    logger.warning("Retrying")
+                rate_limiter.on_throttle(retry_after)
+                # Streamed responses keep their pooled connection until closed
+                response.close()
+                number_of_retries += 1
+                if number_of_retries > DSSConstants.MAX_THROTTLING_RETRIES:
+                    raise Exception("SharePoint is still throttling after {} retries, giving up".format(DSSConstants.MAX_THROTTLING_RETRIES))
+                logger.warning("SharePoint is throttling... Sleeping for {} seconds".format(retry_after))
+                should_retry = True
+                logger.warning("Retrying")
+            elif is_quota_nearly_used(response):
+                rate_limiter.on_quota_warning()
+            else:
+                rate_limiter.on_success()
         error_message = get_error(response)
         if raise_on:
             status_code = response.status_code
@@ -52,6 +108,9 @@ class Office365Session():
             raise Exception(error_message)
         return response
 
+    def get_rate_limiter(self, url):
+        return rate_limiter_registry.get_rate_limiter(self.tenant_id, get_resource_from_url(url))
+
     def get(self, **kwargs):
         kwargs["method"] = "GET"
         response = self.request(**kwargs)
@@ -65,6 +124,7 @@ class Office365Session():
         return headers
 
     def get_item(self, **kwargs):
+        add_query_options(kwargs)
         kwargs["headers"] = kwargs.get("headers", {})
         kwargs["headers"].update(DSSConstants.JSON_HEADERS)
         kwargs["headers"].update(DSSConstants.GZIP_HEADERS)
@@ -82,6 +142,29 @@ class Office365Session():
         return json_response
 
     def get_next_item(self, **kwargs):
+        for json_response in self.get_next_page(**kwargs):
+            items = json_response.get("value", [])
+            for item in items:
+                yield item
+
+    def get_next_page(self, **kwargs):
+        # prefetch_depth > 0 fetches the next pages in the background while the current one is processed
+        prefetch_depth = kwargs.pop("prefetch_depth", None)
+        max_prefetch_size = kwargs.pop("max_prefetch_size", None)
+        pages = self.get_next_sized_page(**kwargs)
+        if not prefetch_depth:
+            for json_response, _ in pages:
+                yield json_response
+            return
+        read_ahead_pager = Office365ReadAheadPager(pages, prefetch_depth=prefetch_depth, max_buffered_size=max_prefetch_size)
+        try:
+            for json_response in read_ahead_pager:
+                yield json_response
+        finally:
+            read_ahead_pager.close()
+
+    def get_next_sized_page(self, **kwargs):
+        add_query_options(kwargs)
         kwargs["headers"] = kwargs.get("headers", {})
         kwargs["headers"].update(DSSConstants.JSON_HEADERS)
         kwargs["headers"].update(DSSConstants.GZIP_HEADERS)
@@ -98,9 +181,7 @@ class Office365Session():
             is_first_get = False
             json_response = response.json()
             next_page_url = get_next_page_url(json_response)
-            items = json_response.get("value", [])
-            for item in items:
-                yield item
+            yield json_response, len(response.content)
 
     def get_next_site(self):
         for site in self.get_next_item(
@@ -109,13 +190,16 @@ class Office365Session():
         ):
             yield site
 
-    def get_my_tasks(self):
+    def get_my_tasks(self, prefetch_depth=None):
         # https://graph.microsoft.com/v1.0/me/planner/tasks
-        for task in self.get_next_item(url=self.get_endpoint_url_for("me/planner/tasks")):
+        for task in self.get_next_item(url=self.get_endpoint_url_for("me/planner/tasks"), prefetch_depth=prefetch_depth):
             yield task
 
-    def get_next_task(self, plan_id):
-        for task in self.get_next_item(url=self.get_endpoint_url_for("planner/plans/{}/tasks".format(plan_id))):
+    def get_next_task(self, plan_id, prefetch_depth=None):
+        for task in self.get_next_item(
+            url=self.get_endpoint_url_for("planner/plans/{}/tasks".format(plan_id)),
+            prefetch_depth=prefetch_depth
+        ):
             yield task
 
     def get_next_plan(self, group_id):
@@ -130,6 +214,12 @@ class Office365Session():
             items.append(item)
         return items
 
+    def get_batch_writer(self, batch_size=None, concurrency=None, fail_fast=True, ignored_statuses=None):
+        return Office365BatchWriter(
+            self, batch_size=batch_size, concurrency=concurrency,
+            fail_fast=fail_fast, ignored_statuses=ignored_statuses
+        )
+
     def start_batch_mode(self, batch_size=None):
         batch_size = batch_size or DSSConstants.DEFAULT_BATCH_SIZE
         self.is_batch_mode = True
@@ -137,13 +227,57 @@ class Office365Session():
         self.requests_buffer = []
 
     def close(self):
-        self.flush()
-        self.is_batch_mode = False
+        try:
+            return self.flush()
+        finally:
+            self.is_batch_mode = False
 
     def flush(self):
-        responses = self.process_batch(self.requests_buffer)
+        requests_buffer = self.requests_buffer
         self.requests_buffer = []
-        assert_responses_ok(responses)
+        results = self.execute_batch(requests_buffer)
+        failures = get_batch_failures(results)
+        if failures:
+            logger.error("Error during batch, dumping failures: {}".format(failures))
+            raise Office365BatchError(failures)
+        return results
+
+    def execute_batch(self, requests_buffer):
+        # Returns one sub-response per buffered request, in the same order.
+        # Throttled sub-requests, and the ones that failed because they depend on them,
+        # are sent again after the largest Retry-After.
+        results = [None] * len(requests_buffer)
+        batch_ids = get_batch_ids(requests_buffer)
+        pending_indexes = list(range(len(requests_buffer)))
+        number_of_retries = 0
+        while pending_indexes:
+            responses = self.process_batch(
+                [requests_buffer[index] for index in pending_indexes],
+                batch_ids=[batch_ids[index] for index in pending_indexes]
+            )
+            responses_by_id = {}
+            for response in responses:
+                responses_by_id[response.get("id")] = response
+            throttled_indexes = []
+            failed_dependency_indexes = []
+            max_retry_after = 0
+            for index in pending_indexes:
+                response = responses_by_id.get(batch_ids[index], {"id": batch_ids[index], "status": 500, "body": {}})
+                if is_throttled_sub_response(response):
+                    throttled_indexes.append(index)
+                    max_retry_after = max(max_retry_after, get_sub_response_retry_after(response))
+                elif int(response.get("status", 200)) == 424:
+                    failed_dependency_indexes.append(index)
+                results[index] = response
+            retry_indexes = sorted(throttled_indexes + failed_dependency_indexes) if throttled_indexes else []
+            if retry_indexes and number_of_retries < DSSConstants.MAX_BATCH_RETRIES:
+                number_of_retries += 1
+                logger.warning("{} batched request(s) throttled, retrying in {} seconds".format(len(retry_indexes), max_retry_after))
+                self.get_rate_limiter(self.get_batch_url()).on_throttle(max_retry_after)
+                pending_indexes = retry_indexes
+            else:
+                pending_indexes = []
+        return results
 
     def get_site(self, site_id):
         return Office365Site(self, site_id)
@@ -182,15 +316,15 @@ class Office365Session():
     def get_drive(self, drive_id):
         return Office365Drive(self, drive_id)
 
-    def process_batch(self, requests_buffer):
+    def process_batch(self, requests_buffer, batch_ids=None):
         if not requests_buffer:
             return {}
+        batch_ids = batch_ids or get_batch_ids(requests_buffer)
         data = {}
         requests = []
-        counter = 1
-        for request_kwargs in requests_buffer:
+        for request_kwargs, batch_id in zip(requests_buffer, batch_ids):
             request = {
-                "id": "{}".format(counter),
+                "id": batch_id,
                 "method": request_kwargs.get("method"),
                 "url": self.get_relative_url(request_kwargs.get("url")),
             }
@@ -200,16 +334,21 @@ class Office365Session():
                 request["body"] = request_kwargs.get("json")
             if request_kwargs.get("data"):
                 request["data"] = request_kwargs.get("data")
+            # dependsOn can only point inside the same batch. Dependencies sent in a previous batch are already done.
+            depends_on = [depend_on for depend_on in request_kwargs.get("depends_on") or [] if depend_on in batch_ids]
+            if depends_on:
+                request["dependsOn"] = depends_on
             requests.append(
                 request
             )
-            counter += 1
         data["requests"] = requests
-        response = self.session.request(
+        response = self.request(
             method="POST",
             url=self.get_batch_url(),
             headers=DSSConstants.JSON_HEADERS,
-            json=data
+            json=data,
+            cannot_raise=True,
+            force_no_batch=True
         )
         status_code = response.status_code
         if status_code >= 400:
@@ -248,7 +387,7 @@ class Office365Session():
         return relative_url
 
     def get_endpoint_url(self):
-        return "https://graph.microsoft.com/v1.0"
+        return self.endpoint_url or "https://graph.microsoft.com/v1.0"
 
     def get_endpoint_url_for(self, root_path):
         return "/".join(
@@ -282,32 +421,260 @@ def get_relative_url(url_base, full_url):
     return relative_url
 
 
-def assert_responses_ok(responses):
-    max_retry_after = 0
-    for response in responses:
-        if int(response.get("status", 200)) >= 400:
-            logger.error("Error during batch, dumping responses: {}".format(responses))
-            raise Exception("Batch id {} failed with error {}. {} / {}".format(
-                response.get("id"),
-                response.get("status"),
-                response.get("body"),
-                response.get("header")
-            ))
-        retry_after = response.get("header", {}).get("Retry-After", 0)
-        if retry_after > max_retry_after:
-            max_retry_after = retry_after
-    return True
+def add_query_options(kwargs):
+    # select (list of fields) and top (page size) are turned into OData query parameters
+    select = kwargs.pop("select", None)
+    top = kwargs.pop("top", None)
+    if not select and not top:
+        return
+    params = dict(kwargs.get("params") or {})
+    if select:
+        params["$select"] = ",".join(select)
+    if top:
+        params["$top"] = top
+    kwargs["params"] = params
+
+
+def get_batch_ids(requests_buffer):
+    # Buffered requests can carry their own batch_id, so that others can refer to it with depends_on
+    batch_ids = []
+    for counter, request_kwargs in enumerate(requests_buffer, start=1):
+        batch_ids.append("{}".format(request_kwargs.get("batch_id") or counter))
+    return batch_ids
+
+
+def get_batch_failures(results):
+    failures = []
+    for result in results:
+        status = int(result.get("status", 200))
+        if status >= 400:
+            body = result.get("body") or {}
+            error = body.get("error", {}) if isinstance(body, dict) else {}
+            failures.append(
+                {
+                    "id": result.get("id"),
+                    "status": status,
+                    "code": error.get("code"),
+                    "message": error.get("message"),
+                    "body": body
+                }
+            )
+    return failures
+
+
+class Office365BatchError(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        first_failure = failures[0]
+        super(Office365BatchError, self).__init__(
+            "{} batched request(s) failed. First one: id {} failed with error {}. {}".format(
+                len(failures),
+                first_failure.get("id"),
+                first_failure.get("status"),
+                first_failure.get("message") or first_failure.get("body")
+            )
+        )
+
+
+class Office365BatchReader(object):
+    # Queues GET requests and sends them through $batch, batch_size at a time.
+    # Each callback receives its own sub-response: {"id": .., "status": .., "headers": {..}, "body": {..}}
+    def __init__(self, session, batch_size=None):
+        self.session = session
+        self.batch_size = batch_size or DSSConstants.MAX_BATCH_SIZE
+        self.queued_requests = []
+
+    def get(self, url, callback):
+        self.queued_requests.append((url, callback))
+        if len(self.queued_requests) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        queued_requests = self.queued_requests
+        self.queued_requests = []
+        results = self.session.execute_batch(
+            [{"method": "GET", "url": url} for url, callback in queued_requests]
+        )
+        for (url, callback), result in zip(queued_requests, results):
+            callback(result)
+
+
+class Office365BatchWriter(object):
+    # Groups write requests into batches of batch_size and sends up to concurrency batches at the same time.
+    # Throttled sub-requests are retried on their own by execute_batch. Failures are raised on close,
+    # or as soon as the next batch is submitted when fail_fast is set.
+    # Sub-responses with a status in ignored_statuses (e.g. 404 on delete) are not failures.
+    def __init__(self, session, batch_size=None, concurrency=None, fail_fast=True, ignored_statuses=None):
+        self.session = session
+        self.fail_fast = fail_fast
+        self.ignored_statuses = ignored_statuses or []
+        self.batch_size = min(batch_size or DSSConstants.MAX_BATCH_SIZE, DSSConstants.MAX_BATCH_SIZE)
+        self.concurrency = concurrency or DSSConstants.DEFAULT_WRITE_CONCURRENCY
+        self.pool = BoundedThreadPool(max_workers=self.concurrency, max_pending=self.concurrency)
+        self.queued_requests = []
+        self.lock = threading.Lock()
+        self.failures = []
+        self.errors = []
+        self.number_of_requests_sent = 0
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+
+    def add(self, request_kwargs):
+        self.queued_requests.append(request_kwargs)
+        if len(self.queued_requests) >= self.batch_size:
+            self.submit_queued_requests()
+
+    def submit_queued_requests(self):
+        if self.fail_fast:
+            self.raise_on_errors()
+        queued_requests = self.queued_requests
+        self.queued_requests = []
+        if queued_requests:
+            future = self.pool.submit(self.session.execute_batch, queued_requests)
+            future.add_done_callback(lambda done_future: self.on_batch_done(done_future, len(queued_requests)))
+
+    def on_batch_done(self, future, number_of_requests):
+        error = future.exception()
+        with self.lock:
+            if error:
+                self.errors.append(error)
+                return
+            for failure in get_batch_failures(future.result()):
+                if failure.get("status") not in self.ignored_statuses:
+                    self.failures.append(failure)
+            self.number_of_requests_sent += number_of_requests
+            now = time.time()
+            if now - self.last_report_time >= DSSConstants.WRITE_REPORT_INTERVAL:
+                self.last_report_time = now
+                logger.info(self.get_throughput_report())
+
+    def get_throughput_report(self):
+        duration = max(time.time() - self.start_time, 0.001)
+        return "{} request(s) sent in {:.1f}s ({:.1f} rows/s)".format(
+            self.number_of_requests_sent, duration, self.number_of_requests_sent / duration
+        )
+
+    def raise_on_errors(self):
+        with self.lock:
+            if self.errors:
+                raise self.errors[0]
+            if self.failures:
+                logger.error("Error during batch, dumping failures: {}".format(self.failures))
+                raise Office365BatchError(self.failures)
+
+    def close(self):
+        try:
+            self.submit_queued_requests()
+        finally:
+            self.pool.shutdown(wait=True)
+        logger.info(self.get_throughput_report())
+        self.raise_on_errors()
+
+
+def is_throttled_sub_response(response):
+    return int(response.get("status", 200)) in [429, 503]
+
+
+def get_sub_response_retry_after(response):
+    retry_after = response.get("headers", {}).get("Retry-After")
+    if retry_after:
+        return int(retry_after)
+    return DSSConstants.DEFAULT_RETRY_AFTER
 
 
 class Office365ListWriter(object):
-    def __init__(self, list, dataset_schema, batch_size=None):
+    def __init__(self, list, dataset_schema, batch_size=None, concurrency=None):
         self.list = list
+        self.batch_writer = None
         if batch_size and batch_size > 1:
-            self.list.session.start_batch_mode(batch_size=batch_size)
+            self.batch_writer = Office365BatchWriter(self.list.session, batch_size=batch_size, concurrency=concurrency)
+        self.columns = dataset_schema.get("columns")
+        self.row_mapper = Office365WriteRowMapper(self.columns)
+
+    def write_row(self, row):
+        if self.batch_writer:
+            self.batch_writer.add(self.list.get_write_row_request(self.row_mapper.map_row(row)))
+        else:
+            self.list.write_row(self.row_mapper.map_row(row))
+
+    def close(self):
+        if self.batch_writer:
+            self.batch_writer.close()
+
+
+class Office365ListUpsertWriter(object):
+    # Compares the incoming rows with the list content, indexed by key_column,
+    # and only sends the creations, updates and, if delete_missing is set, deletions that are needed
+    def __init__(self, list, dataset_schema, key_column, delete_missing=False, batch_size=None, concurrency=None):
+        self.list = list
         self.columns = dataset_schema.get("columns")
+        self.column_names = [column.get("name") for column in self.columns]
+        if key_column not in self.column_names:
+            raise Exception("The key column '{}' is not in the dataset".format(key_column))
+        self.key_column = key_column
+        self.delete_missing = delete_missing
+        self.row_mapper = Office365WriteRowMapper(self.columns)
+        self.batch_writer = Office365BatchWriter(self.list.session, batch_size=batch_size, concurrency=concurrency)
+        self.existing_items = self.index_existing_items()
+        self.written_keys = set()
+        self.counts = {"created": 0, "updated": 0, "unchanged": 0, "deleted": 0, "skipped": 0}
+
+    def index_existing_items(self):
+        # One read of the list, limited to the dataset's columns: {key value: (item id, row hash)}
+        existing_items = {}
+        select_list = list(self.column_names)
+        list_schema = self.list.get_schema()
+        for column_name in self.column_names:
+            column = list_schema.get_column(column_name)
+            if column and ("lookup" in column or "personOrGroup" in column) and not is_multi_valued_lookup(column):
+                select_list.append(column_name + SharePointConstants.LOOKUP_ID_SUFFIX)
+        for item in self.list.get_next_row(
+            select_list=",".join(select_list),
+            top=DSSConstants.MAX_PAGE_SIZE,
+            prefetch_depth=DSSConstants.DEFAULT_PREFETCH_DEPTH
+        ):
+            fields = item.get("fields", {})
+            key = normalize_value(fields.get(self.key_column))
+            if key is None:
+                continue
+            if key in existing_items:
+                logger.warning("Key '{}' is used by several items of the list, only one will be updated".format(key))
+            existing_items[key] = (item.get("id"), get_row_hash(fields, self.column_names))
+        logger.info("{} item(s) indexed by '{}'".format(len(existing_items), self.key_column))
+        return existing_items
 
     def write_row(self, row):
-        self.list.write_row(prepare_row(row, self.columns))
+        mapped_row = self.row_mapper.map_row(row)
+        key = normalize_value(mapped_row.get(self.key_column))
+        if key is None:
+            logger.warning("Skipping a row without value in the key column '{}'".format(self.key_column))
+            self.counts["skipped"] += 1
+            return
+        if key in self.written_keys:
+            # Only the first row of a key is written, otherwise new keys would be created several times
+            logger.warning("Key '{}' appears several times in the dataset, skipping the repeated row".format(key))
+            self.counts["skipped"] += 1
+            return
+        self.written_keys.add(key)
+        existing_item = self.existing_items.get(key)
+        if existing_item is None:
+            self.batch_writer.add(self.list.get_write_row_request(mapped_row))
+            self.counts["created"] += 1
+            return
+        item_id, item_hash = existing_item
+        if item_hash == get_row_hash(mapped_row, self.column_names):
+            self.counts["unchanged"] += 1
+            return
+        self.batch_writer.add(self.list.get_update_row_request(item_id, mapped_row))
+        self.counts["updated"] += 1
 
     def close(self):
-        self.list.session.close()
+        try:
+            if self.delete_missing:
+                for key, (item_id, _) in self.existing_items.items():
+                    if key not in self.written_keys:
+                        self.batch_writer.add(self.list.get_delete_row_request(item_id))
+                        self.counts["deleted"] += 1
+        finally:
+            self.batch_writer.close()
+        logger.info("Upsert done: {}".format(self.counts))
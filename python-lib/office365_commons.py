@@ -1,6 +1,14 @@
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from safe_logger import SafeLogger
+from dss_constants import DSSConstants
+import base64
+import hashlib
+import json
+import os
 import requests
+import tempfile
+import threading
 
 
 logger = SafeLogger("office-365 plugin", [])
@@ -49,20 +57,27 @@ def get_credentials_from_keypair(connection_info):
     thumbprint = params.get("thumbprint")
     scopes = params.get("scopes")
 
-    import msal
-    logger.info("geting credentials from keypair")
-    app = msal.ConfidentialClientApplication(
-        client_id,
-        authority="https://login.microsoftonline.com/{}".format(tenant_id),
-        client_credential={
-            "thumbprint": thumbprint,
-            "private_key": format_private_key(private_key),
-            # "passphrase": self.passphrase,
-        },
-    )
-    logger.info("acquiring token")
-    json_response = app.acquire_token_for_client(scopes=[scopes])
-    return json_response
+    cache_key = "{}:{}:{}".format(tenant_id, client_id, scopes)
+
+    def acquire_token():
+        import msal
+        logger.info("geting credentials from keypair")
+        app = msal.ConfidentialClientApplication(
+            client_id,
+            authority="https://login.microsoftonline.com/{}".format(tenant_id),
+            client_credential={
+                "thumbprint": thumbprint,
+                "private_key": format_private_key(private_key),
+                # "passphrase": self.passphrase,
+            },
+        )
+        return app.acquire_token_for_client(scopes=[scopes])
+
+    from office365_auth import token_cache
+    # The private key is only known to the processes using this connection, so it is used to encrypt the cache on disk
+    disk_cache_secret = private_key if DSSConstants.TOKEN_CACHE_ON_DISK else None
+    access_token = token_cache.get_token(cache_key, acquire_token, disk_cache_secret=disk_cache_secret)
+    return {"access_token": access_token}
 
 
 def format_private_key(private_key):
@@ -137,6 +152,13 @@ def get_sharepoint_type_descriptor(dss_type):
     return sharepoint_type_descriptor
 
 
+def get_prefetch_depth(config):
+    prefetch_depth = config.get("prefetch_depth")
+    if prefetch_depth is None:
+        return DSSConstants.DEFAULT_PREFETCH_DEPTH
+    return int(prefetch_depth)
+
+
 def get_next_page_url(json_response):
     return json_response.get("@odata.nextLink", None)
 
@@ -149,12 +171,13 @@ def get_error(response):
         status_code = response.status_code
         if status_code >= 400:
             error_message = "Error {} while accessing {}".format(status_code, response.url)
-        try:
-            json_response = response.json()
-            enriched_error_message = json_response.get("error", "").get("message", "")
-            error_message += ". {}".format(enriched_error_message)
-        except Exception as sub_error_message:
-            logger.debug("Could not decode json: {}".format(sub_error_message))
+            # Only decode the body on error, so that streamed responses are not read in memory
+            try:
+                json_response = response.json()
+                enriched_error_message = json_response.get("error", "").get("message", "")
+                error_message += ". {}".format(enriched_error_message)
+            except Exception as sub_error_message:
+                logger.debug("Could not decode json: {}".format(sub_error_message))
     if error_message:
         logger.error(error_message)
         logger.error("Dumping content: {}".format(response.content))
@@ -169,20 +192,87 @@ def get_retry_after_value(response):
     retry_after_value = response.headers.get("Retry-After")
     if retry_after_value:
         return int(retry_after_value)
-    return 30
+    return DSSConstants.DEFAULT_RETRY_AFTER
+
+
+def is_quota_nearly_used(response):
+    # SharePoint sends RateLimit-* headers once 80% of the quota is used, before any 429
+    remaining = response.headers.get("RateLimit-Remaining")
+    limit = response.headers.get("RateLimit-Limit")
+    if remaining is None or not limit:
+        return False
+    try:
+        return int(remaining) < int(limit) * 0.2
+    except ValueError:
+        return False
+
+
+def get_tenant_id_from_token(access_token):
+    # The tenant id is read from the token's 'tid' claim, without checking the signature, to key the rate limiters
+    try:
+        payload = access_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("tid") or "default"
+    except Exception:
+        return "default"
+
+
+class BoundedThreadPool(object):
+    # Thread pool with a cap on queued tasks: submit() blocks when the cap is reached
+    def __init__(self, max_workers, max_pending=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending_slots = threading.BoundedSemaphore(max_pending or 2 * max_workers)
+
+    def submit(self, function, *args, **kwargs):
+        self.pending_slots.acquire()
+        try:
+            future = self.executor.submit(function, *args, **kwargs)
+        except Exception:
+            self.pending_slots.release()
+            raise
+        future.add_done_callback(self.release_slot)
+        return future
 
+    def release_slot(self, future):
+        self.pending_slots.release()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def get_local_cache_path(namespace, key):
+    # Local state shared between successive runs of the plugin on the same DSS node
+    file_name = "{}.json".format(hashlib.sha1(key.encode("utf-8")).hexdigest())
+    return os.path.join(tempfile.gettempdir(), "dss-plugin-office-365", namespace, file_name)
 
-def prepare_row(row, columns):
-    prepared_row = {}
-    for item, column in zip(row, columns):
-        column_type = column.get("type")
-        if column_type == "int":
-            prepared_row[column.get("name")] = int(item)
-        elif column_type == "float":
-            prepared_row[column.get("name")] = float(item)
-        else:
-            prepared_row[column.get("name")] = str(item)
-    return prepared_row
+
+def read_local_cache(namespace, key):
+    cache_path = get_local_cache_path(namespace, key)
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path, "r") as cache_file:
+            return json.load(cache_file)
+    except Exception as error:
+        logger.warning("Could not read local cache {}: {}".format(cache_path, error))
+        return None
+
+
+def write_local_cache(namespace, key, data):
+    cache_path = get_local_cache_path(namespace, key)
+    cache_directory = os.path.dirname(cache_path)
+    if not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory, exist_ok=True)
+    temporary_path = "{}.{}.{}.tmp".format(cache_path, os.getpid(), threading.get_ident())
+    with open(temporary_path, "w") as cache_file:
+        json.dump(data, cache_file)
+    os.replace(temporary_path, cache_path)
+
+
+def delete_local_cache(namespace, key):
+    cache_path = get_local_cache_path(namespace, key)
+    if os.path.isfile(cache_path):
+        os.remove(cache_path)
 
 
 def assert_response_ok(response, context=None):
@@ -258,19 +348,35 @@ class LookupList():
         self.list = []
         self.columns_to_lookup = []
         self.columns_to_select = []
+        self.lookup_columns = []
         self.must_see_columns = must_see_columns
 
     def append(self, column):
         if not isinstance(column, dict):
             return
         name = column.get("name")
-        if 'lookup' in column:
+        is_lookup = 'lookup' in column or 'personOrGroup' in column
+        if is_lookup:
             self.columns_to_lookup.append("fields/{}".format(name))
         if column.get("readOnly") is False or name in self.must_see_columns:
             self.columns_to_select.append(name)
+            if is_lookup:
+                self.lookup_columns.append(column)
+            if is_lookup and not is_multi_valued_lookup(column):
+                # Single value lookups are only returned when their id field is selected
+                self.columns_to_select.append("{}LookupId".format(name))
+
+    def get_lookup_columns(self):
+        return self.lookup_columns
 
     def get_fields(self):
         return "fields," + ",".join(self.columns_to_lookup)
 
     def get_select(self):
         return ",".join(self.columns_to_select)
+
+
+def is_multi_valued_lookup(column):
+    lookup = column.get("lookup") or {}
+    person_or_group = column.get("personOrGroup") or {}
+    return bool(lookup.get("allowMultipleValues") or person_or_group.get("allowMultipleSelection"))
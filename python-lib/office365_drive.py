@@ -1,6 +1,13 @@
-from office365_commons import assert_response_ok
+from office365_commons import get_error, read_local_cache, write_local_cache, delete_local_cache
 from sharepoint_constants import SharePointConstants
 from dss_constants import DSSConstants
+from safe_logger import SafeLogger
+import hashlib
+import tempfile
+import time
+
+
+logger = SafeLogger("office-365 plugin", [])
 
 
 class Office365Drive(object):
@@ -8,14 +15,22 @@ class Office365Drive(object):
         self.session = parent
         self.drive_id = drive_id
 
-    def get_item(self, item_path):
+    def get_item(self, item_path, select=None):
+        item = self.session.get_item(
+            url=self.get_item_url(item_path),
+            select=select
+        )
+        return item
+
+    def get_item_by_id(self, item_id, select=None):
         item = self.session.get_item(
-            url=self.get_item_url(item_path)
+            url=self.get_item_by_id_url(item_id),
+            select=select
         )
         return item
 
     def get_permission_list(self, item_id):
-        url = self.get_item_by_id_url(item_id) + "/permissions"
+        url = self.get_permission_list_url(item_id)
         list = self.session.get_item(
             url=url
         )
@@ -31,17 +46,30 @@ class Office365Drive(object):
         group = self.session.get_item(url=url)
         return group
 
-    def get_next_child(self, folder_path):
+    def get_next_child(self, folder_path, select=None, prefetch_depth=None):
         url = self.get_children_url(folder_path)
-        for child in self.session.get_next_item(url=url):
+        for child in self.session.get_next_item(url=url, select=select, top=DSSConstants.MAX_PAGE_SIZE, prefetch_depth=prefetch_depth):
             yield child
 
-    def get_next_child_by_id(self, folder_id):
+    def get_next_child_by_id(self, folder_id, select=None, prefetch_depth=None):
         for item in self.session.get_next_item(
-            url=self.get_item_by_id_children_url(folder_id)
+            url=self.get_item_by_id_children_url(folder_id),
+            select=select,
+            top=DSSConstants.MAX_PAGE_SIZE,
+            prefetch_depth=prefetch_depth
         ):
             yield item
 
+    def get_next_delta_page(self, delta_link=None):
+        # The last page carries the @odata.deltaLink to use for the next call
+        url = delta_link or self.get_delta_url()
+        headers = {
+            # Also report items whose sharing changed, and deletions as deleted items
+            "Prefer": "deltashowremovedasdeleted, deltatraversepermissiongaps, deltashowsharingchanges"
+        }
+        for page in self.session.get_next_page(url=url, headers=headers):
+            yield page
+
     def delete_item_by_id(self, item_id):
         self.session.request(
             method="DELETE",
@@ -74,43 +102,157 @@ class Office365Drive(object):
         json_response = response.json()
         return json_response
 
-    def create_empty_item(self, parent_id, path):
+    def read_file_content(self, download_url, output_stream, limit=None, chunk_size=SharePointConstants.FILE_DOWNLOAD_CHUNK_SIZE):
+        # Streams the file into output_stream chunk by chunk. With a limit, only the first bytes are requested
+        headers = {}
+        bytes_left = None
+        if limit and limit > 0:
+            headers["Range"] = "bytes=0-{}".format(limit - 1)
+            bytes_left = limit
+        response = self.session.get(
+            url=download_url,
+            headers=headers,
+            stream=True
+        )
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if bytes_left is not None:
+                    # The server can ignore the Range header and send the whole file
+                    chunk = chunk[:bytes_left]
+                    bytes_left -= len(chunk)
+                output_stream.write(chunk)
+                if bytes_left == 0:
+                    break
+        finally:
+            response.close()
+
+    def upload_file(self, parent_id, path, stream):
+        # The DSS stream has no known size, and upload sessions need it in every Content-Range header,
+        # so it is spooled first: in memory for small files, on local disk above the simple upload limit
+        with tempfile.SpooledTemporaryFile(max_size=SharePointConstants.SIMPLE_UPLOAD_MAX_SIZE) as spooled_file:
+            file_hash = hashlib.sha1()
+            while True:
+                data = stream.read(SharePointConstants.FILE_DOWNLOAD_CHUNK_SIZE)
+                if not data:
+                    break
+                file_hash.update(data)
+                spooled_file.write(data)
+            file_size = spooled_file.tell()
+            spooled_file.seek(0)
+            if file_size <= SharePointConstants.SIMPLE_UPLOAD_MAX_SIZE:
+                return self.write_file_content(parent_id, path, spooled_file.read())
+            fingerprint = "{}:{}".format(file_size, file_hash.hexdigest())
+            checkpoint_key = "{}:{}:{}".format(self.drive_id, parent_id, path)
+            upload_url, start_offset = self.get_upload_checkpoint(checkpoint_key, fingerprint)
+            if not upload_url:
+                json_response = self.create_upload_session_by_path(parent_id, path)
+                upload_url = json_response.get("uploadUrl")
+                write_local_cache(
+                    SharePointConstants.UPLOAD_CHECKPOINTS_CACHE,
+                    checkpoint_key,
+                    {
+                        "upload_url": upload_url,
+                        "fingerprint": fingerprint,
+                        "expiration": json_response.get("expirationDateTime")
+                    }
+                )
+            json_response = self.write_chunked_stream_content(upload_url, spooled_file, file_size, start_offset=start_offset)
+            delete_local_cache(SharePointConstants.UPLOAD_CHECKPOINTS_CACHE, checkpoint_key)
+            return json_response
+
+    def get_upload_checkpoint(self, checkpoint_key, fingerprint):
+        # An upload interrupted by a previous run of the job can be resumed if the session is still alive
+        checkpoint = read_local_cache(SharePointConstants.UPLOAD_CHECKPOINTS_CACHE, checkpoint_key)
+        if not checkpoint or checkpoint.get("fingerprint") != fingerprint:
+            return None, 0
+        upload_url = checkpoint.get("upload_url")
+        start_offset = self.get_upload_session_next_offset(upload_url, None)
+        if start_offset is None:
+            delete_local_cache(SharePointConstants.UPLOAD_CHECKPOINTS_CACHE, checkpoint_key)
+            return None, 0
+        logger.info("Resuming upload from offset {}".format(start_offset))
+        return upload_url, start_offset
+
+    def write_file_content(self, parent_id, path, data):
         response = self.session.request(
             method="PUT",
-            url=self.get_content_url(parent_id, path)
+            url=self.get_content_url(parent_id, path),
+            headers={"Content-Type": "application/octet-stream"},
+            data=data,
+            force_no_batch=True
         )
         json_response = response.json()
         return json_response
 
-    def create_upload_session(self, item_id):
+    def create_upload_session_by_path(self, parent_id, path):
         response = self.session.request(
             method="POST",
-            url=self.get_create_upload_session_url(item_id)
+            url=self.get_create_upload_session_by_path_url(parent_id, path),
+            force_no_batch=True
         )
         json_response = response.json()
         return json_response
 
-    def write_chunked_file_content(self, upload_url, data, chunk_size=SharePointConstants.FILE_UPLOAD_CHUNK_SIZE):
-        file_size = len(data)
-        save_upload_offset = 0
+    def write_chunked_stream_content(self, upload_url, file_handle, file_size, chunk_size=None, start_offset=0):
+        # Without chunk_size, the chunk size adapts to the measured throughput.
+        # Chunks are read into a reusable buffer and sent as memoryview slices, so no copy is made.
+        # Upload sessions only accept fragments in sequential order, so one chunk is in flight at a time.
+        chunk_sizer = UploadChunkSizer(chunk_size)
+        buffer = bytearray(0)
+        save_upload_offset = start_offset
+        number_of_retries = 0
+        json_response = {}
         while save_upload_offset < file_size:
-            next_save_upload_offset = save_upload_offset + chunk_size
-            if next_save_upload_offset > file_size:
-                next_save_upload_offset = file_size
-            headers = DSSConstants.JSON_HEADERS
-            headers.update(
-                {
-                    "Content-Range": "bytes {}-{}/{}".format(save_upload_offset, next_save_upload_offset-1, file_size)
-                }
-            )
-            response = self.session.request(
-                method="PUT",
-                url=upload_url,
-                headers=headers,
-                data=data[save_upload_offset:next_save_upload_offset]
-            )
-            assert_response_ok(response)
-            save_upload_offset = next_save_upload_offset
+            next_chunk_size = min(chunk_sizer.chunk_size, file_size - save_upload_offset)
+            if next_chunk_size > len(buffer):
+                buffer = bytearray(next_chunk_size)
+            buffer_view = memoryview(buffer)[:next_chunk_size]
+            file_handle.seek(save_upload_offset)
+            chunk_length = read_into(file_handle, buffer_view)
+            if not chunk_length:
+                raise Exception("Unexpected end of file at offset {} out of {}".format(save_upload_offset, file_size))
+            headers = {
+                "Content-Range": "bytes {}-{}/{}".format(save_upload_offset, save_upload_offset + chunk_length - 1, file_size)
+            }
+            start_time = time.time()
+            try:
+                response = self.session.request(
+                    method="PUT",
+                    url=upload_url,
+                    headers=headers,
+                    data=buffer_view[:chunk_length],
+                    cannot_raise=True,
+                    force_no_batch=True
+                )
+                error_message = get_error(response)
+            except Exception as error:
+                error_message = "{}".format(error)
+            if not error_message:
+                chunk_sizer.update(chunk_length, time.time() - start_time)
+                save_upload_offset += chunk_length
+                number_of_retries = 0
+                if response.content:
+                    json_response = response.json()
+                continue
+            number_of_retries += 1
+            if number_of_retries > SharePointConstants.MAX_RETRIES:
+                raise Exception("Upload failed at offset {}: {}".format(save_upload_offset, error_message))
+            logger.warning("Chunk at offset {} failed ({}), retrying".format(save_upload_offset, error_message))
+            time.sleep(SharePointConstants.WAIT_TIME_BEFORE_RETRY_SEC)
+            save_upload_offset = self.get_upload_session_next_offset(upload_url, save_upload_offset)
+        return json_response
+
+    def get_upload_session_next_offset(self, upload_url, default_offset):
+        # The upload session tells which bytes it is still waiting for, e.g. {"nextExpectedRanges": ["26-"]}
+        try:
+            upload_session = self.session.get_item(url=upload_url, force_no_batch=True)
+            next_expected_ranges = upload_session.get("nextExpectedRanges") or []
+        except Exception as error:
+            logger.warning("Could not get the upload session status: {}".format(error))
+            return default_offset
+        if not next_expected_ranges:
+            return default_offset
+        return int(next_expected_ranges[0].split("-")[0])
 
     def get_children_url(self, folder_path):
         if (not folder_path) or (folder_path == "/"):
@@ -119,6 +261,26 @@ class Office365Drive(object):
             url = self.get_item_url(folder_path) + ":/children"
         return url
 
+    def get_delta_url(self):
+        # On SharePoint drives, delta is only available on the root folder
+        url = "/".join(
+            [
+                self.get_drives_url(),
+                "root",
+                "delta"
+            ]
+        )
+        return url
+
+    def get_permission_list_url(self, item_id):
+        url = "/".join(
+            [
+                self.get_item_by_id_url(item_id),
+                "permissions"
+            ]
+        )
+        return url
+
     def get_item_by_id_children_url(self, item_id):
         url = "/".join(
             [
@@ -138,10 +300,11 @@ class Office365Drive(object):
         )
         return url
 
-    def get_create_upload_session_url(self, item_id):
+    def get_create_upload_session_by_path_url(self, content_parent_id, content_path):
         url = "/".join(
             [
-                self.get_item_by_id_url(item_id),
+                self.get_item_by_id_url("{}:".format(content_parent_id)),
+                "{}:".format(content_path),
                 "createUploadSession"
             ]
         )
@@ -184,6 +347,37 @@ class Office365Drive(object):
         )
 
 
+class UploadChunkSizer(object):
+    # Picks chunk sizes that are multiples of 320 KiB, so that each PUT lasts about UPLOAD_CHUNK_TARGET_DURATION_SEC
+    def __init__(self, chunk_size=None):
+        self.is_adaptive = chunk_size is None
+        self.chunk_size = chunk_size or SharePointConstants.UPLOAD_CHUNK_INITIAL_SIZE
+
+    def update(self, chunk_length, elapsed_time):
+        if not self.is_adaptive or elapsed_time <= 0 or chunk_length < self.chunk_size:
+            return
+        throughput = chunk_length / elapsed_time
+        target_size = throughput * SharePointConstants.UPLOAD_CHUNK_TARGET_DURATION_SEC
+        # Do not more than double or halve the chunk size in one step
+        target_size = min(max(target_size, self.chunk_size / 2), self.chunk_size * 2)
+        self.chunk_size = round_to_upload_unit(target_size)
+
+
+def round_to_upload_unit(size):
+    number_of_units = int(size // SharePointConstants.UPLOAD_CHUNK_UNIT)
+    number_of_units = max(1, min(number_of_units, SharePointConstants.UPLOAD_CHUNK_MAX_SIZE // SharePointConstants.UPLOAD_CHUNK_UNIT))
+    return number_of_units * SharePointConstants.UPLOAD_CHUNK_UNIT
+
+
+def read_into(file_handle, buffer_view):
+    # SpooledTemporaryFile only has readinto from Python 3.11
+    if hasattr(file_handle, "readinto"):
+        return file_handle.readinto(buffer_view)
+    data = file_handle.read(len(buffer_view))
+    buffer_view[:len(data)] = data
+    return len(data)
+
+
 def split_file_path(file_path):
     file_path_tokens = file_path.split("/")
     path_to_file = "/".join(file_path_tokens[:-1])
@@ -0,0 +1,103 @@
+from office365_commons import read_local_cache, write_local_cache
+from sharepoint_constants import SharePointConstants
+from safe_logger import SafeLogger
+
+
+logger = SafeLogger("office-365 plugin", [])
+
+
+class Office365DriveIndex(object):
+    # Local copy of a drive tree, kept up to date with the drive delta endpoint.
+    # The index and its delta link are persisted on disk, so that the next scan only fetches what changed.
+    # Items are tracked by id, since delta responses on SharePoint drives do not contain parent paths.
+    def __init__(self, drive, cache_key=None):
+        # Each consumer needs its own cache_key, as syncing the index consumes the changes
+        self.drive = drive
+        self.cache_key = ":".join([drive.drive_id, cache_key]) if cache_key else "{}".format(drive.drive_id)
+        self.items = {}
+        self.delta_link = None
+        self.children_ids = None
+        self.load()
+
+    def load(self):
+        cache = read_local_cache(SharePointConstants.DRIVE_INDEX_CACHE, self.cache_key) or {}
+        self.items = cache.get("items", {})
+        self.delta_link = cache.get("delta_link")
+
+    def save(self):
+        write_local_cache(
+            SharePointConstants.DRIVE_INDEX_CACHE,
+            self.cache_key,
+            {
+                "items": self.items,
+                "delta_link": self.delta_link
+            }
+        )
+
+    def reset(self):
+        self.items = {}
+        self.delta_link = None
+
+    def sync(self, save=True):
+        # Returns the drive items changed since the last sync, deleted ones included.
+        # With save=False, the caller saves the index once it has processed the changes,
+        # so that they are fetched again if it fails before that.
+        if self.delta_link:
+            try:
+                changed_items = self.apply_changes(self.delta_link)
+            except Exception as error:
+                # Delta links expire (410 Gone), in which case the whole drive has to be listed again
+                logger.warning("Could not use the delta link ({}), rebuilding the index".format(error))
+                self.reset()
+                changed_items = self.apply_changes(None)
+        else:
+            logger.info("Building the index of drive {}".format(self.drive.drive_id))
+            changed_items = self.apply_changes(None)
+        self.children_ids = None
+        if save:
+            self.save()
+        return changed_items
+
+    def apply_changes(self, delta_link):
+        changed_items = []
+        for page in self.drive.get_next_delta_page(delta_link):
+            for item in page.get("value", []):
+                self.apply_change(item)
+                changed_items.append(item)
+            self.delta_link = page.get("@odata.deltaLink") or self.delta_link
+        logger.info("{} change(s) in drive {}".format(len(changed_items), self.drive.drive_id))
+        return changed_items
+
+    def apply_change(self, item):
+        item_id = item.get("id")
+        if "deleted" in item:
+            self.items.pop(item_id, None)
+            return
+        self.items[item_id] = {
+            "id": item_id,
+            "parent_id": item.get("parentReference", {}).get("id"),
+            "name": item.get("name"),
+            "is_folder": "folder" in item,
+            "size": item.get("size"),
+            "last_modified": item.get("lastModifiedDateTime")
+        }
+
+    def get_children_ids(self, folder_id):
+        if self.children_ids is None:
+            self.children_ids = {}
+            for item_id, item in self.items.items():
+                self.children_ids.setdefault(item.get("parent_id"), []).append(item_id)
+        return self.children_ids.get(folder_id, [])
+
+    def get_next_file(self, folder_id, folder_path=""):
+        # Yields (path, item) for all the files below folder_id, paths being relative to that folder
+        folders_to_scan = [(folder_id, folder_path)]
+        while folders_to_scan:
+            current_folder_id, current_folder_path = folders_to_scan.pop()
+            for child_id in self.get_children_ids(current_folder_id):
+                child = self.items.get(child_id)
+                child_path = "/".join([current_folder_path, child.get("name")]) if current_folder_path else child.get("name")
+                if child.get("is_folder"):
+                    folders_to_scan.append((child_id, child_path))
+                else:
+                    yield child_path, child
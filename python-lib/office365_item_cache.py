@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from dss_constants import DSSConstants
+import threading
+import time
+
+
+class Office365ItemCache(object):
+    # TTL + LRU cache of driveItems, keyed by normalized full path, with an index by item id.
+    # Items not found on the drive are cached too, as {}.
+    # Folder listings are kept as the paths of their children, so that a folder can be listed again by id.
+    def __init__(self, max_size=None, time_to_live=None):
+        self.lock = threading.Lock()
+        self.max_size = max_size or DSSConstants.ITEM_CACHE_MAX_SIZE
+        self.time_to_live = time_to_live or DSSConstants.ITEM_CACHE_TIME_TO_LIVE
+        self.items = OrderedDict()
+        self.paths_by_id = {}
+        self.children_paths = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        # Returns None when the path is not cached
+        key = normalize_path(path)
+        with self.lock:
+            cached = self.items.get(key)
+            if cached is None or cached[0] < time.time():
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+    def get_by_id(self, item_id):
+        with self.lock:
+            path = self.paths_by_id.get(item_id)
+        if path is None:
+            return None
+        return self.get(path)
+
+    def get_children_by_id(self, folder_id):
+        # Returns None unless the folder was listed and none of its children has expired since
+        with self.lock:
+            folder_key = self.paths_by_id.get(folder_id)
+            children_paths = self.children_paths.get(folder_key)
+        if children_paths is None:
+            return None
+        children = []
+        for child_path in children_paths:
+            child = self.get(child_path)
+            if not child:
+                return None
+            children.append(child)
+        return children
+
+    def put(self, path, item):
+        key = normalize_path(path)
+        with self.lock:
+            self.put_item(key, item)
+            while len(self.items) > self.max_size:
+                oldest_key = next(iter(self.items))
+                self.remove(oldest_key)
+
+    def put_children(self, folder_path, children):
+        folder_key = normalize_path(folder_path)
+        children_paths = []
+        for child in children:
+            child_path = "/".join([folder_key, child.get("name")])
+            self.put(child_path, child)
+            children_paths.append(child_path)
+        with self.lock:
+            if folder_key in self.items:
+                self.children_paths[folder_key] = children_paths
+
+    def invalidate(self, path):
+        # Drops the path, everything below it, and its parent folder whose size and date change with it
+        key = normalize_path(path)
+        parent_key = "/".join(key.split("/")[:-1])
+        with self.lock:
+            for cached_key in list(self.items.keys()):
+                if cached_key == key or cached_key == parent_key or cached_key.startswith(key + "/"):
+                    self.remove(cached_key)
+
+    def put_item(self, key, item):
+        # Replacing a folder's item keeps its listing, which is only dropped with the folder itself
+        cached = self.items.pop(key, None)
+        if cached and cached[1]:
+            self.paths_by_id.pop(cached[1].get("id"), None)
+        self.items[key] = (time.time() + self.time_to_live, item)
+        if item and item.get("id"):
+            self.paths_by_id[item.get("id")] = key
+
+    def remove(self, key):
+        cached = self.items.pop(key, None)
+        self.children_paths.pop(key, None)
+        if cached and cached[1]:
+            self.paths_by_id.pop(cached[1].get("id"), None)
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.items)
+            }
+
+
+def normalize_path(path):
+    return "/".join([element for element in (path or "").split("/") if element])
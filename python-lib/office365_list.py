@@ -1,7 +1,12 @@
 from office365_commons import get_sharepoint_type_descriptor
+from office365_list_schema import list_schema_cache
+from safe_logger import SafeLogger
 from dss_constants import DSSConstants
 
 
+logger = SafeLogger("office-365 plugin", [])
+
+
 class Office365List(object):
     def __init__(self, parent, list_id):
         self.session = parent.session
@@ -9,9 +14,30 @@ class Office365List(object):
         self.parent = parent
 
     def get_columns(self):
+        return self.get_schema().columns
+
+    def get_schema(self):
+        return list_schema_cache.get_schema(self.get_schema_cache_key(), self.get_etag, self.get_columns_from_sharepoint)
+
+    def get_schema_cache_key(self):
+        return "{}:{}".format(self.parent.get_site_url(), self.list_id)
+
+    def get_columns_from_sharepoint(self):
         url = self.get_column_url()
         return self.session.get_all_items(url=url)
 
+    def get_etag(self):
+        return self.session.get_item(url=self.get_list_url(), select=["eTag"]).get("eTag")
+
+    def get_list_url(self):
+        return "/".join(
+            [
+                self.parent.get_site_url(), "lists/{}".format(
+                    self.list_id
+                )
+            ]
+        )
+
     def get_column_url(self):
         url = "/".join(
             [
@@ -22,23 +48,59 @@ class Office365List(object):
         )
         return url
 
-    def get_next_row(self, lookup_list=None, select_list=None):
+    def get_next_row(self, lookup_list=None, select_list=None, filter_query=None, order_by=None, top=None, allow_non_indexed_queries=False, prefetch_depth=None):
         lookup_list = lookup_list or "field"
         select_list = select_list or ""
         url = self.get_next_list_row_url()
         if select_list:
-            expand = {
+            params = {
                 "expand": "fields(select={})".format(select_list)
             }
         else:
-            expand = {"expand": "{}".format(lookup_list)}
+            params = {"expand": "{}".format(lookup_list)}
+        # Filters and sort orders apply to list columns, e.g. "fields/Created ge '2024-01-01'"
+        if filter_query:
+            params["$filter"] = filter_query
+        if order_by:
+            params["$orderby"] = order_by
+        if top:
+            params["$top"] = top
+        headers = {}
+        if allow_non_indexed_queries:
+            headers["Prefer"] = "HonorNonIndexedQueriesWarningMayFailRandomly"
         for row in self.session.get_next_item(
             url=url,
-            params=expand,
-            force_no_batch=True
+            params=params,
+            headers=headers,
+            force_no_batch=True,
+            prefetch_depth=prefetch_depth
         ):
             yield row
 
+    def get_next_delta_page(self, delta_link=None, select_list=None, prefetch_depth=None):
+        # The last page carries the @odata.deltaLink to use for the next call
+        params = None
+        if not delta_link and select_list:
+            params = {"expand": "fields(select={})".format(select_list)}
+        elif not delta_link:
+            params = {"expand": "fields"}
+        for page in self.session.get_next_page(
+            url=delta_link or self.get_list_items_delta_url(),
+            params=params,
+            force_no_batch=True,
+            prefetch_depth=prefetch_depth
+        ):
+            yield page
+
+    def get_list_items_delta_url(self):
+        url = "/".join(
+            [
+                self.get_next_list_row_url(),
+                "delta"
+            ]
+        )
+        return url
+
     def get_next_list_row_url(self):
         url = "/".join(
             [
@@ -70,24 +132,37 @@ class Office365List(object):
             json=data,
             raise_on={403: "Check that your Azure app has Sites.Manage.All scope enabled"}
         )
+        list_schema_cache.invalidate(self.get_schema_cache_key())
 
     def write_row(self, row):
-        headers = DSSConstants.JSON_HEADERS
-        data = {
-            "fields": row,
+        self.session.request(**self.get_write_row_request(row))
+
+    def get_write_row_request(self, row):
+        return {
+            "method": "POST",
+            "url": self.get_next_list_row_url(),
+            "headers": DSSConstants.JSON_HEADERS,
+            "json": {
+                "fields": row,
+            }
+        }
+
+    def get_update_row_request(self, row_id, row):
+        return {
+            "method": "PATCH",
+            "url": "/".join([self.get_list_row_id_url(row_id), "fields"]),
+            "headers": DSSConstants.JSON_HEADERS,
+            "json": row
         }
-        self.session.request(
-            method="POST",
-            url=self.get_next_list_row_url(),
-            headers=headers,
-            json=data
-        )
 
     def delete_row(self, row_id):
-        self.session.request(
-            method="DELETE",
-            url=self.get_list_row_id_url(row_id)
-        )
+        self.session.request(**self.get_delete_row_request(row_id))
+
+    def get_delete_row_request(self, row_id):
+        return {
+            "method": "DELETE",
+            "url": self.get_list_row_id_url(row_id)
+        }
 
     def get_list_row_id_url(self, row_id):
         url = "/".join(
@@ -101,9 +176,20 @@ class Office365List(object):
         )
         return url
 
-    def delete_all_rows(self):
-        self.session.start_batch_mode()
-        for row in self.get_next_row():
-            row_id = row.get("id")
-            self.delete_row(row_id)
-        self.session.close()
+    def delete_all_rows(self, concurrency=None):
+        # Ids are all read first, so that paging is not disturbed by the deletions.
+        # Failed deletions are reported at the end rather than stopping the clear half way.
+        row_ids = [
+            row.get("id") for row in self.session.get_next_item(
+                url=self.get_next_list_row_url(),
+                select=["id"],
+                top=DSSConstants.MAX_PAGE_SIZE,
+                force_no_batch=True,
+                prefetch_depth=DSSConstants.DEFAULT_PREFETCH_DEPTH
+            )
+        ]
+        logger.info("Deleting {} item(s)".format(len(row_ids)))
+        batch_writer = self.session.get_batch_writer(concurrency=concurrency, fail_fast=False, ignored_statuses=[404])
+        for row_id in row_ids:
+            batch_writer.add(self.get_delete_row_request(row_id))
+        batch_writer.close()
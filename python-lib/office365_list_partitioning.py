@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+from dss_constants import DSSConstants
+
+
+PERIOD_FORMATS = {
+    "YEAR": "%Y",
+    "MONTH": "%Y-%m",
+    "DAY": "%Y-%m-%d"
+}
+
+
+class Office365ListPartitioning(object):
+    # Splits a list into DSS partitions, either by period of a date column ("date")
+    # or by ranges of item ids ("id_range"). Each partition is read with its own server side filter.
+    def __init__(self, mode, column=None, period=None, id_range_size=None):
+        self.mode = mode
+        self.column = column
+        self.period = period or "MONTH"
+        self.id_range_size = int(id_range_size or DSSConstants.DEFAULT_ID_RANGE_SIZE)
+        if self.mode == "date" and not self.column:
+            raise Exception("A date column must be set to partition the list by date")
+        if self.period not in PERIOD_FORMATS:
+            raise Exception("Partitioning period {} is not supported".format(self.period))
+
+    def is_enabled(self):
+        return self.mode in ["date", "id_range"]
+
+    def get_partitioning(self):
+        if self.mode == "date":
+            return {
+                "dimensions": [
+                    {"name": self.column, "type": "time", "params": {"period": self.period}}
+                ]
+            }
+        return {
+            "dimensions": [
+                {"name": "id_range", "type": "value"}
+            ]
+        }
+
+    def get_filter(self, partition_id):
+        if self.mode == "date":
+            start_date = datetime.strptime(partition_id, PERIOD_FORMATS.get(self.period))
+            end_date = get_next_period_start(start_date, self.period)
+            return "fields/{column} ge '{start}' and fields/{column} lt '{end}'".format(
+                column=self.column,
+                start=start_date.strftime(DSSConstants.ODATA_DATE_FORMAT),
+                end=end_date.strftime(DSSConstants.ODATA_DATE_FORMAT)
+            )
+        first_id, last_id = get_id_range(partition_id)
+        return "fields/ID ge {} and fields/ID le {}".format(first_id, last_id)
+
+    def list_partition_ids(self, sharepoint_list, allow_non_indexed_queries=False):
+        # Only the first and last items are read, to get the bounds of the partitions
+        if self.mode == "date":
+            first_value = self.get_boundary_value(sharepoint_list, "asc", allow_non_indexed_queries)
+            last_value = self.get_boundary_value(sharepoint_list, "desc", allow_non_indexed_queries)
+            if not first_value or not last_value:
+                return []
+            partition_ids = []
+            period_format = PERIOD_FORMATS.get(self.period)
+            period_start = datetime.strptime(parse_date(first_value).strftime(period_format), period_format)
+            last_date = parse_date(last_value)
+            while period_start <= last_date:
+                partition_ids.append(period_start.strftime(period_format))
+                period_start = get_next_period_start(period_start, self.period)
+            return partition_ids
+        last_id = self.get_boundary_value(sharepoint_list, "desc", allow_non_indexed_queries)
+        if not last_id:
+            return []
+        partition_ids = []
+        for range_start in range(1, int(last_id) + 1, self.id_range_size):
+            partition_ids.append("{}-{}".format(range_start, range_start + self.id_range_size - 1))
+        return partition_ids
+
+    def get_boundary_value(self, sharepoint_list, direction, allow_non_indexed_queries):
+        column = self.column if self.mode == "date" else "ID"
+        rows = sharepoint_list.get_next_row(
+            select_list=column,
+            order_by="fields/{} {}".format(column, direction),
+            top=1,
+            allow_non_indexed_queries=allow_non_indexed_queries
+        )
+        row = next(rows, None)
+        if not row:
+            return None
+        if self.mode == "date":
+            return row.get("fields", {}).get(column)
+        return row.get("id")
+
+
+def get_id_range(partition_id):
+    first_id, last_id = partition_id.split("-")
+    return int(first_id), int(last_id)
+
+
+def parse_date(value):
+    return datetime.strptime(value, DSSConstants.ODATA_DATE_FORMAT)
+
+
+def get_next_period_start(period_start, period):
+    if period == "YEAR":
+        return period_start.replace(year=period_start.year + 1)
+    if period == "MONTH":
+        if period_start.month == 12:
+            return period_start.replace(year=period_start.year + 1, month=1)
+        return period_start.replace(month=period_start.month + 1)
+    return period_start + timedelta(days=1)
@@ -0,0 +1,91 @@
+import threading
+import time
+from office365_commons import read_local_cache, write_local_cache, delete_local_cache, is_multi_valued_lookup
+from sharepoint_constants import SharePointConstants
+from dss_constants import DSSConstants
+
+
+class Office365ListSchema(object):
+    # Columns of a list, indexed by internal name and by display name
+    def __init__(self, columns, etag=None):
+        self.columns = columns
+        self.etag = etag
+        self.columns_by_name = {}
+        self.columns_by_display_name = {}
+        for column in columns:
+            self.columns_by_name[column.get("name")] = column
+            self.columns_by_display_name.setdefault(column.get("displayName"), column)
+
+    def get_column(self, name):
+        return self.columns_by_name.get(name)
+
+    def get_column_by_display_name(self, display_name):
+        return self.columns_by_display_name.get(display_name)
+
+    def has_column(self, name):
+        return name in self.columns_by_name
+
+    def get_read_schema(self, column_names):
+        # Same columns, in the same order and with the same names, as the rows built by Office365ReadRowMapper
+        schema_columns = [{"name": "ID", "type": "string"}]
+        display_names = set(["ID"])
+        for column_name in column_names:
+            column = self.columns_by_name.get(column_name)
+            if not column or column.get("displayName") in display_names:
+                continue
+            display_names.add(column.get("displayName"))
+            schema_columns.append({"name": column.get("displayName"), "type": sharepoint_to_dss_type(column)})
+        return {"columns": schema_columns}
+
+
+class Office365ListSchemaCache(object):
+    # Keeps each list's columns in memory and on disk for LIST_SCHEMA_TIME_TO_LIVE seconds.
+    # Past that, the cached columns are kept if the list's eTag has not changed.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.schemas = {}
+
+    def get_schema(self, cache_key, get_etag, get_columns):
+        now = time.time()
+        with self.lock:
+            cached_schema = self.schemas.get(cache_key)
+        if cached_schema is None:
+            cached_schema = read_local_cache(SharePointConstants.LIST_SCHEMA_CACHE, cache_key)
+        if cached_schema and now - cached_schema.get("timestamp", 0) < SharePointConstants.LIST_SCHEMA_TIME_TO_LIVE:
+            return Office365ListSchema(cached_schema.get("columns"), etag=cached_schema.get("etag"))
+        etag = get_etag()
+        if cached_schema and etag and cached_schema.get("etag") == etag:
+            columns = cached_schema.get("columns")
+        else:
+            columns = get_columns()
+        cached_schema = {"columns": columns, "etag": etag, "timestamp": now}
+        with self.lock:
+            self.schemas[cache_key] = cached_schema
+        write_local_cache(SharePointConstants.LIST_SCHEMA_CACHE, cache_key, cached_schema)
+        return Office365ListSchema(columns, etag=etag)
+
+    def invalidate(self, cache_key):
+        with self.lock:
+            self.schemas.pop(cache_key, None)
+        delete_local_cache(SharePointConstants.LIST_SCHEMA_CACHE, cache_key)
+
+
+list_schema_cache = Office365ListSchemaCache()
+
+
+def get_sharepoint_type(sharepoint_column):
+    # Graph describes a column's type with a facet, e.g. {"name": "Price", "currency": {"locale": "en-us"}}
+    for facet, sharepoint_type in SharePointConstants.GRAPH_COLUMN_TYPES.items():
+        if facet in sharepoint_column:
+            if facet == "calculated":
+                # Calculated columns are typed after their result, e.g. "outputType": "number"
+                output_type = (sharepoint_column.get("calculated") or {}).get("outputType")
+                return SharePointConstants.GRAPH_COLUMN_TYPES.get(output_type, sharepoint_type)
+            return sharepoint_type
+    return SharePointConstants.FALLBACK_TYPE
+
+
+def sharepoint_to_dss_type(sharepoint_column):
+    if is_multi_valued_lookup(sharepoint_column):
+        return "array"
+    return SharePointConstants.TYPES.get(get_sharepoint_type(sharepoint_column)) or DSSConstants.FALLBACK_TYPE
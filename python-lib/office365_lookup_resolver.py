@@ -0,0 +1,116 @@
+import urllib.parse
+from office365_client import Office365BatchReader
+from office365_commons import is_multi_valued_lookup
+from safe_logger import SafeLogger
+from sharepoint_constants import SharePointConstants
+from dss_constants import DSSConstants
+
+
+logger = SafeLogger("office-365 plugin", [])
+
+
+class Office365LookupResolver(object):
+    # Replaces the ids of single value lookup and person fields by the value they point to.
+    # Each target list is read once into a lookup table of at most LOOKUP_TABLE_MAX_SIZE items.
+    # Ids missing from the table are fetched with batched requests, once per page of rows.
+    def __init__(self, sharepoint_list, lookup_columns):
+        self.session = sharepoint_list.session
+        self.site_url = sharepoint_list.parent.get_site_url()
+        self.targets = []
+        for lookup_column in lookup_columns:
+            target = get_lookup_target(lookup_column)
+            if target:
+                self.targets.append(
+                    (lookup_column.get("name") + SharePointConstants.LOOKUP_ID_SUFFIX, target)
+                )
+        self.lookup_tables = {}
+        self.batch_reader = Office365BatchReader(self.session)
+
+    def has_targets(self):
+        return len(self.targets) > 0
+
+    def resolve(self, items):
+        missing_ids = {}
+        for item in items:
+            fields = item.get("fields", {})
+            for key, target in self.targets:
+                item_id = fields.get(key)
+                if item_id is None:
+                    continue
+                lookup_table = self.get_lookup_table(target)
+                if item_id not in lookup_table:
+                    missing_ids.setdefault(target, set()).add(item_id)
+        for target, item_ids in missing_ids.items():
+            for item_id in item_ids:
+                self.batch_reader.get(
+                    url=self.get_item_url(target, item_id),
+                    callback=lambda response, target=target, item_id=item_id: self.set_value(target, item_id, response)
+                )
+        self.batch_reader.flush()
+        for item in items:
+            fields = item.get("fields", {})
+            for key, target in self.targets:
+                item_id = fields.get(key)
+                if item_id is not None:
+                    fields[key] = self.lookup_tables.get(target, {}).get(item_id, item_id)
+        return items
+
+    def get_lookup_table(self, target):
+        lookup_table = self.lookup_tables.get(target)
+        if lookup_table is None:
+            lookup_table = self.load_lookup_table(target)
+            self.lookup_tables[target] = lookup_table
+        return lookup_table
+
+    def load_lookup_table(self, target):
+        list_id, column_name = target
+        lookup_table = {}
+        try:
+            for item in self.session.get_next_item(
+                url=self.get_items_url(list_id),
+                params={"expand": "fields(select={})".format(column_name)},
+                top=DSSConstants.MAX_PAGE_SIZE,
+                force_no_batch=True
+            ):
+                lookup_table[item.get("id")] = item.get("fields", {}).get(column_name)
+                if len(lookup_table) >= SharePointConstants.LOOKUP_TABLE_MAX_SIZE:
+                    logger.info("Lookup list {} is too large to be cached, the next ids will be fetched as needed".format(list_id))
+                    break
+        except Exception as error:
+            logger.warning("Could not read lookup list {}, its ids will be fetched as needed ({})".format(list_id, error))
+        return lookup_table
+
+    def set_value(self, target, item_id, response):
+        value = item_id
+        if int(response.get("status", 200)) < 400:
+            list_id, column_name = target
+            value = response.get("body", {}).get("fields", {}).get(column_name, item_id)
+        # Ids that could not be resolved are kept as they are, and are not requested again
+        self.lookup_tables.setdefault(target, {})[item_id] = value
+
+    def get_items_url(self, list_id):
+        return "/".join(
+            [
+                self.site_url,
+                "lists",
+                urllib.parse.quote(list_id),
+                "items"
+            ]
+        )
+
+    def get_item_url(self, target, item_id):
+        list_id, column_name = target
+        return "{}/{}?expand=fields(select={})".format(self.get_items_url(list_id), item_id, column_name)
+
+
+def get_lookup_target(lookup_column):
+    # (list id, column name) holding the values of a single value lookup or person column
+    if is_multi_valued_lookup(lookup_column):
+        # Multiple values fields already come with their LookupValue
+        return None
+    if "personOrGroup" in lookup_column:
+        return (SharePointConstants.USER_INFORMATION_LIST, "Title")
+    lookup = lookup_column.get("lookup") or {}
+    if not lookup.get("listId"):
+        return None
+    return (lookup.get("listId"), lookup.get("columnName") or "Title")
@@ -3,7 +3,7 @@ class Office365Messages(object):
         self.session = parent
         self.search_space = "user" or search_space
 
-    def get_next_message(self, user_principal_name=None, folder_id=None):
+    def get_next_message(self, user_principal_name=None, folder_id=None, prefetch_depth=None):
         if self.search_space == "user":
             url = "/".join(
                 [
@@ -43,6 +43,7 @@ class Office365Messages(object):
                 ]
             )
         for message in self.session.get_next_item(
-            url=url
+            url=url,
+            prefetch_depth=prefetch_depth
         ):
             yield message
@@ -0,0 +1,104 @@
+from dss_constants import DSSConstants
+import threading
+import time
+
+
+class Office365RateLimiter(object):
+    # Client side rate limit for one tenant and resource, shared by all the sessions of the process.
+    # Requests are spaced to match the current rate, with some burst allowed. The rate grows slowly
+    # on success and is cut when Graph throttles or warns that the quota is nearly used (AIMD).
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = rate or DSSConstants.RATE_LIMIT_INITIAL_RATE
+        self.theoretical_arrival_time = 0
+        self.resume_time = 0
+        self.number_of_requests = 0
+        self.number_of_throttled_requests = 0
+        self.total_sleep_time = 0
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            interval = 1.0 / self.rate
+            theoretical_arrival_time = max(self.theoretical_arrival_time, now)
+            start_time = max(
+                now,
+                theoretical_arrival_time - DSSConstants.RATE_LIMIT_BURST * interval,
+                self.resume_time
+            )
+            self.theoretical_arrival_time = max(theoretical_arrival_time, start_time) + interval
+            self.number_of_requests += 1
+            sleep_time = start_time - now
+            if sleep_time > 0:
+                self.total_sleep_time += sleep_time
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(DSSConstants.RATE_LIMIT_MAX_RATE, self.rate + DSSConstants.RATE_LIMIT_INCREASE)
+
+    def on_quota_warning(self):
+        with self.lock:
+            self.rate = max(DSSConstants.RATE_LIMIT_MIN_RATE, self.rate * DSSConstants.RATE_LIMIT_WARNING_DECREASE)
+
+    def on_throttle(self, retry_after):
+        with self.lock:
+            self.number_of_throttled_requests += 1
+            self.rate = max(DSSConstants.RATE_LIMIT_MIN_RATE, self.rate * DSSConstants.RATE_LIMIT_THROTTLE_DECREASE)
+            self.resume_time = max(self.resume_time, time.time() + retry_after)
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "requests": self.number_of_requests,
+                "throttled_requests": self.number_of_throttled_requests,
+                "total_sleep_time": self.total_sleep_time
+            }
+
+
+class Office365RateLimiterRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rate_limiters = {}
+
+    def get_rate_limiter(self, tenant_id, resource):
+        key = "{}/{}".format(tenant_id, resource)
+        with self.lock:
+            if key not in self.rate_limiters:
+                self.rate_limiters[key] = Office365RateLimiter()
+            return self.rate_limiters[key]
+
+    def get_metrics(self):
+        with self.lock:
+            rate_limiters = dict(self.rate_limiters)
+        metrics = {}
+        for key, rate_limiter in rate_limiters.items():
+            metrics[key] = rate_limiter.get_metrics()
+        return metrics
+
+
+rate_limiter_registry = Office365RateLimiterRegistry()
+
+
+def get_rate_limiter_metrics():
+    return rate_limiter_registry.get_metrics()
+
+
+def get_resource_from_url(url):
+    # Graph applies its limits per service, so drives, lists and mail are limited separately
+    url = (url or "").lower()
+    if not url.startswith("https://graph.microsoft.com") and "sharepoint.com" in url:
+        return "downloads"
+    if "$batch" in url:
+        return "batch"
+    if "/lists" in url:
+        return "lists"
+    if "/drives" in url or "/drive/" in url:
+        return "drives"
+    if "/messages" in url or "/mailfolders" in url:
+        return "mail"
+    if "/planner" in url:
+        return "planner"
+    return "graph"
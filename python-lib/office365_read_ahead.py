@@ -0,0 +1,79 @@
+import threading
+from collections import deque
+from safe_logger import SafeLogger
+from dss_constants import DSSConstants
+
+
+logger = SafeLogger("office-365 plugin", [])
+
+
+class Office365ReadAheadPager(object):
+    # Fetches the next pages of a paged response on a background thread while the current one is consumed.
+    # pages is an iterator of (json_response, size_in_bytes). Fetching pauses once prefetch_depth pages,
+    # or max_buffered_size bytes, are waiting to be consumed.
+    def __init__(self, pages, prefetch_depth=None, max_buffered_size=None):
+        self.pages = pages
+        self.prefetch_depth = max(1, int(prefetch_depth or DSSConstants.DEFAULT_PREFETCH_DEPTH))
+        self.max_buffered_size = max_buffered_size or DSSConstants.PREFETCH_MAX_BUFFERED_SIZE
+        self.condition = threading.Condition()
+        self.buffer = deque()
+        self.buffered_size = 0
+        self.is_done = False
+        self.is_closed = False
+        self.error = None
+        self.thread = None
+
+    def __iter__(self):
+        self.thread = threading.Thread(target=self.fetch_pages)
+        self.thread.daemon = True
+        self.thread.start()
+        try:
+            while True:
+                with self.condition:
+                    while not self.buffer and not self.is_done:
+                        self.condition.wait()
+                    if self.buffer:
+                        json_response, size = self.buffer.popleft()
+                        self.buffered_size -= size
+                        self.condition.notify_all()
+                    elif self.error:
+                        raise self.error
+                    else:
+                        return
+                yield json_response
+        finally:
+            self.close()
+
+    def fetch_pages(self):
+        try:
+            for json_response, size in self.pages:
+                with self.condition:
+                    if self.is_closed:
+                        return
+                    self.buffer.append((json_response, size))
+                    self.buffered_size += size
+                    self.condition.notify_all()
+                    # A single page bigger than the cap is still accepted, so that reading always progresses
+                    while not self.is_closed and (
+                        len(self.buffer) >= self.prefetch_depth or self.buffered_size >= self.max_buffered_size
+                    ):
+                        self.condition.wait()
+                    if self.is_closed:
+                        return
+        except Exception as error:
+            logger.error("Error while prefetching page: {}".format(error))
+            with self.condition:
+                self.error = error
+        finally:
+            with self.condition:
+                self.is_done = True
+                self.condition.notify_all()
+            self.pages.close()
+
+    def close(self):
+        # Called when the consumer stops early, so that no more pages are fetched
+        with self.condition:
+            self.is_closed = True
+            self.buffer.clear()
+            self.buffered_size = 0
+            self.condition.notify_all()
@@ -0,0 +1,201 @@
+from office365_commons import is_multi_valued_lookup
+from office365_list_schema import sharepoint_to_dss_type
+from sharepoint_constants import SharePointConstants
+from dss_constants import DSSConstants
+from datetime import datetime, timezone
+import hashlib
+import json
+import re
+
+
+ISO_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?$")
+# UTC formats used by SharePoint and by DSS. datetime.fromisoformat is not available on Python 3.6
+ISO_DATE_FORMATS = [SharePointConstants.TIME_FORMAT, DSSConstants.DATE_FORMAT, SharePointConstants.DATE_FORMAT]
+
+
+class Office365ReadRowMapper(object):
+    # Built once per read from the list columns: maps each SharePoint field key
+    # to its DSS column name and to the function converting its value
+    def __init__(self, sharepoint_columns):
+        self.mappings = {}
+        for sharepoint_column in sharepoint_columns:
+            name = sharepoint_column.get("name")
+            display_name = sharepoint_column.get("displayName")
+            converter = get_read_converter(sharepoint_column)
+            self.mappings[name] = (display_name, converter)
+            if is_lookup_column(sharepoint_column):
+                # Single value lookup and person fields are returned by Graph as <name>LookupId
+                self.mappings[name + SharePointConstants.LOOKUP_ID_SUFFIX] = (display_name, None)
+        # Special case for the id column, because, why not...
+        self.mappings["id"] = ("ID", None)
+
+    def map_row(self, row):
+        mapped_row = {}
+        mappings = self.mappings
+        for key, value in row.get("fields", {}).items():
+            mapping = mappings.get(key)
+            if mapping is None:
+                continue
+            display_name, converter = mapping
+            if converter is None or value is None:
+                mapped_row[display_name] = value
+            else:
+                mapped_row[display_name] = converter(value)
+        return mapped_row
+
+
+class Office365WriteRowMapper(object):
+    # Built once per write from the dataset schema, so that each row is converted without looking up its columns' types
+    def __init__(self, dss_columns):
+        self.mappings = tuple(
+            (dss_column.get("name"), get_write_converter(dss_column.get("type"))) for dss_column in dss_columns
+        )
+
+    def map_row(self, row):
+        mapped_row = {}
+        for (name, converter), value in zip(self.mappings, row):
+            mapped_row[name] = None if value is None else converter(value)
+        return mapped_row
+
+
+def is_lookup_column(sharepoint_column):
+    return "lookup" in sharepoint_column or "personOrGroup" in sharepoint_column
+
+
+def get_read_converter(sharepoint_column):
+    if is_multi_valued_lookup(sharepoint_column):
+        return convert_lookup_values
+    if is_lookup_column(sharepoint_column):
+        return convert_lookup_value
+    # Dates are kept in their ISO 8601 form, which DSS reads directly into date columns
+    return READ_CONVERTERS.get(sharepoint_to_dss_type(sharepoint_column))
+
+
+def convert_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def convert_boolean(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ["true", "1", "yes"]
+
+
+def convert_lookup_value(value):
+    # Multi values lookup and person fields come as lists of {"LookupId": ..., "LookupValue": ...}
+    if isinstance(value, list):
+        return [convert_lookup_value(element) for element in value]
+    if isinstance(value, dict):
+        return value.get("LookupValue", value.get("Email", value.get("LookupId")))
+    return value
+
+
+def convert_lookup_values(value):
+    # Serialized like objects, so that values match the array type declared in the read schema
+    return convert_to_json(convert_lookup_value(value))
+
+
+def convert_integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return convert_number(value)
+
+
+def convert_to_json(value):
+    # Hyperlink, location and thumbnail fields are objects
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+READ_CONVERTERS = {
+    "double": convert_number,
+    "bigint": convert_integer,
+    "boolean": convert_boolean,
+    "array": convert_lookup_values,
+    "object": convert_to_json
+}
+
+
+def convert_to_string(value):
+    return str(value)
+
+
+def convert_to_boolean(value):
+    if isinstance(value, str):
+        return value.lower() in ["true", "1", "yes"]
+    return bool(value)
+
+
+WRITE_CONVERTERS = {
+    "int": int,
+    "bigint": int,
+    "smallint": int,
+    "tinyint": int,
+    "float": float,
+    "double": float,
+    "boolean": convert_to_boolean
+}
+
+
+def get_write_converter(dss_type):
+    return WRITE_CONVERTERS.get(dss_type, convert_to_string)
+
+
+def get_row_hash(row, column_names):
+    # Same hash for a row read from SharePoint and for the same row coming from DSS
+    values = []
+    for column_name in column_names:
+        value = row.get(column_name)
+        if value is None:
+            # Single value lookup and person fields are read as <name>LookupId
+            value = row.get(column_name + SharePointConstants.LOOKUP_ID_SUFFIX)
+        values.append(normalize_value(value))
+    return hashlib.sha1(json.dumps(values).encode("utf-8")).hexdigest()
+
+
+def normalize_value(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, datetime):
+        return normalize_date(value)
+    if isinstance(value, dict):
+        # Lookup and person values are compared on their ids
+        return normalize_value(value.get("LookupId", value.get("LookupValue")))
+    if isinstance(value, str) and value.startswith("["):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return value
+    if isinstance(value, list):
+        return ",".join(sorted(str(normalize_value(element)) for element in value))
+    value = str(value)
+    if ISO_DATE_PATTERN.match(value):
+        return normalize_iso_date(value)
+    return value
+
+
+def normalize_iso_date(value):
+    # SharePoint returns 2024-01-01T00:00:00Z where DSS sends 2024-01-01T00:00:00.000Z
+    for date_format in ISO_DATE_FORMATS:
+        try:
+            return normalize_date(datetime.strptime(value, date_format))
+        except ValueError:
+            pass
+    return value
+
+
+def normalize_date(date):
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date.strftime(SharePointConstants.TIME_FORMAT)
@@ -4,21 +4,42 @@ class SharePointConstants(object):
     DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
     DEFAULT_VIEW_ENDPOINT = "DefaultView/ViewFields"
     DEFAULT_WAIT_BEFORE_RETRY = 60
+    DRIVE_INDEX_CACHE = "drive-indexes"
+    DRIVE_ITEM_FIELDS = ["id", "name", "size", "folder", "file", "lastModifiedDateTime", "@microsoft.graph.downloadUrl"]
     ENTITY_PROPERTY_NAME = 'EntityPropertyName'
     ERROR_CONTAINER = 'error'
     EXPENDABLES_FIELDS = {"Author": "Title", "Editor": "Title"}
     FALLBACK_TYPE = "Text"
     FILE = 0
+    FILE_DOWNLOAD_CHUNK_SIZE = 1048576
     FILE_SYSTEM_OBJECT_TYPE = "FileSystemObjectType"
-    FILE_UPLOAD_CHUNK_SIZE = 131072000
     FORM_DIGEST_VALUE = "FormDigestValue"
     GET_CONTEXT_WEB_INFORMATION = "GetContextWebInformation"
     GET_FOLDER_URL_STRUCTURE = "{0}/{1}/_api/Web/GetFolderByServerRelativeUrl('/{1}/{2}{3}')"
+    GRAPH_COLUMN_TYPES = {
+        "text": "Text",
+        "number": "Number",
+        "currency": "Currency",
+        "dateTime": "DateTime",
+        "boolean": "Boolean",
+        "choice": "Choice",
+        "lookup": "Lookup",
+        "personOrGroup": "User",
+        "hyperlinkOrPicture": "URL",
+        "geolocation": "Location",
+        "thumbnail": "Thumbnail",
+        "calculated": "Calculated"
+    }
     GET_SITE_APP_TOKEN_URL = "https://accounts.accesscontrol.windows.net/{tenant_id}/tokens/OAuth/2"
     HIDDEN_COLUMN = 'Hidden'
     INTERNAL_NAME = 'InternalName'
     LENGTH = 'Length'
+    LIST_DELTA_CACHE = "list-deltas"
+    LIST_SCHEMA_CACHE = "list-schemas"
+    LIST_SCHEMA_TIME_TO_LIVE = 300
     LOOKUP_FIELD = 'LookupField'
+    LOOKUP_ID_SUFFIX = "LookupId"
+    LOOKUP_TABLE_MAX_SIZE = 5000
     MAX_FILE_SIZE_CONTINUOUS_UPLOAD = 262144000
     MAX_RETRIES = 5
     MESSAGE = 'message'
@@ -31,6 +52,7 @@ class SharePointConstants(object):
     RESULTS = 'results'
     RESULTS_CONTAINER_V2 = 'd'
     SHAREPOINT_ONLINE_RESSOURCE = "00000003-0000-0ff1-ce00-000000000000"
+    SIMPLE_UPLOAD_MAX_SIZE = 4194304
     STATIC_NAME = 'StaticName'
     TIME_LAST_MODIFIED = 'TimeLastModified'
     TITLE_COLUMN = 'Title'
@@ -38,19 +60,30 @@ class SharePointConstants(object):
     TIMEOUT_SEC = 300
     TYPES = {
         "Text": "string",
-        "Number": "string",
+        "Note": "string",
+        "Number": "double",
+        "Currency": "double",
+        "Integer": "bigint",
         "DateTime": "date",
-        "Boolean": "string",
+        "Boolean": "boolean",
+        "Choice": "string",
+        "Lookup": "string",
         "URL": "object",
         "Location": "object",
         "Computed": None,
         "Attachments": None,
         "Calculated": "string",
-        "User": "array",
+        "User": "string",
         "Thumbnail": "object"
     }
     TYPE_AS_STRING = 'TypeAsString'
     TYPE_COLUMN = 'type'
+    UPLOAD_CHECKPOINTS_CACHE = "upload-checkpoints"
+    UPLOAD_CHUNK_INITIAL_SIZE = 10485760
+    UPLOAD_CHUNK_MAX_SIZE = 62914560
+    UPLOAD_CHUNK_TARGET_DURATION_SEC = 10
+    UPLOAD_CHUNK_UNIT = 327680
+    USER_INFORMATION_LIST = "User Information List"
     VALUE = 'value'
     WRITE_MODE_CREATE = "create"
     WAIT_TIME_BEFORE_RETRY_SEC = 2
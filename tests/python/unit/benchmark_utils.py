@@ -0,0 +1,12 @@
+import os
+
+
+BENCH_OUTPUT_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "..", "bench_output.txt")
+
+
+def report_benchmark(name, lines):
+    # Printed (visible with pytest -s) and appended to bench_output.txt at the root of the repository
+    text = "\n".join(["== {} ==".format(name)] + lines + [""])
+    print(text)
+    with open(BENCH_OUTPUT_PATH, "a") as bench_output:
+        bench_output.write(text + "\n")
@@ -0,0 +1,49 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBatchEndpoint(object):
+    # Local stand-in for the Graph $batch endpoint. Each call's sub-requests are recorded,
+    # and respond(sub_request, call_number) returns the (status, headers, body) of each sub-response.
+    def __init__(self, respond):
+        self.respond = respond
+        self.calls = []
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                sub_requests = json.loads(self.rfile.read(length)).get("requests", [])
+                endpoint.calls.append(sub_requests)
+                responses = []
+                for sub_request in sub_requests:
+                    status, headers, body = endpoint.respond(sub_request, len(endpoint.calls))
+                    responses.append({"id": sub_request.get("id"), "status": status, "headers": headers, "body": body})
+                content = json.dumps({"responses": responses}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def get_url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def get_call_ids(self):
+        return [[sub_request.get("id") for sub_request in sub_requests] for sub_requests in self.calls]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,100 @@
+import pytest
+from fake_graph import FakeBatchEndpoint
+from office365_client import Office365Session, Office365BatchError
+from office365_rate_limiter import rate_limiter_registry
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limiters():
+    # Throttled tests slow the shared rate limiters down, each test starts afresh
+    rate_limiter_registry.rate_limiters = {}
+
+
+def post_request(endpoint, batch_id=None, depends_on=None):
+    return {
+        "method": "POST",
+        "url": "{}/sites/site/lists/list/items".format(endpoint.get_url()),
+        "json": {"fields": {"Title": batch_id}},
+        "batch_id": batch_id,
+        "depends_on": depends_on
+    }
+
+
+@pytest.mark.parametrize("throttling_status", [429, 503])
+def test_throttled_sub_requests_are_retried(throttling_status):
+    def respond(sub_request, call_number):
+        if sub_request.get("id") == "2" and call_number == 1:
+            return throttling_status, {"Retry-After": "0"}, {"error": {"code": "TooManyRequests"}}
+        return 201, {}, {"id": sub_request.get("id")}
+
+    with FakeBatchEndpoint(respond) as endpoint:
+        session = Office365Session(access_token="token", endpoint_url=endpoint.get_url())
+        results = session.execute_batch([post_request(endpoint) for _ in range(3)])
+
+    assert endpoint.get_call_ids() == [["1", "2", "3"], ["2"]]
+    assert [result.get("status") for result in results] == [201, 201, 201]
+    assert [result.get("id") for result in results] == ["1", "2", "3"]
+
+
+def test_failed_dependencies_of_throttled_requests_are_resent():
+    def respond(sub_request, call_number):
+        if call_number == 1 and sub_request.get("id") == "parent":
+            return 429, {"Retry-After": "0"}, {}
+        if call_number == 1 and sub_request.get("id") == "child":
+            return 424, {}, {"error": {"code": "FailedDependency"}}
+        return 201, {}, {}
+
+    with FakeBatchEndpoint(respond) as endpoint:
+        session = Office365Session(access_token="token", endpoint_url=endpoint.get_url())
+        results = session.execute_batch([
+            post_request(endpoint, batch_id="parent"),
+            post_request(endpoint, batch_id="child", depends_on=["parent"]),
+            post_request(endpoint, batch_id="other")
+        ])
+
+    assert endpoint.get_call_ids() == [["parent", "child", "other"], ["parent", "child"]]
+    assert endpoint.calls[1][1].get("dependsOn") == ["parent"]
+    assert [result.get("status") for result in results] == [201, 201, 201]
+
+
+def test_dependencies_sent_in_an_earlier_batch_are_dropped():
+    with FakeBatchEndpoint(lambda sub_request, call_number: (201, {}, {})) as endpoint:
+        session = Office365Session(access_token="token", endpoint_url=endpoint.get_url())
+        session.start_batch_mode(batch_size=2)
+        session.request(**post_request(endpoint, batch_id="a"))
+        session.request(**post_request(endpoint, batch_id="b", depends_on=["a"]))
+        session.request(**post_request(endpoint, batch_id="c", depends_on=["b"]))
+        session.close()
+
+    assert endpoint.get_call_ids() == [["a", "b"], ["c"]]
+    assert endpoint.calls[0][1].get("dependsOn") == ["a"]
+    assert "dependsOn" not in endpoint.calls[1][0]
+    assert endpoint.calls[0][0].get("url") == "/sites/site/lists/list/items"
+
+
+def test_batch_failures_are_raised_with_their_details():
+    error_body = {"error": {"code": "invalidRequest", "message": "Field 'Foo' is not recognized"}}
+
+    def respond(sub_request, call_number):
+        if sub_request.get("id") == "2":
+            return 400, {}, error_body
+        return 201, {}, {}
+
+    with FakeBatchEndpoint(respond) as endpoint:
+        session = Office365Session(access_token="token", endpoint_url=endpoint.get_url())
+        session.start_batch_mode(batch_size=20)
+        session.request(**post_request(endpoint))
+        session.request(**post_request(endpoint))
+        with pytest.raises(Office365BatchError) as error:
+            session.close()
+
+    assert error.value.failures == [
+        {
+            "id": "2",
+            "status": 400,
+            "code": "invalidRequest",
+            "message": "Field 'Foo' is not recognized",
+            "body": error_body
+        }
+    ]
+    assert "Field 'Foo' is not recognized" in str(error.value)
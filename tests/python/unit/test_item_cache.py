@@ -0,0 +1,41 @@
+from office365_item_cache import Office365ItemCache
+
+
+def get_cache_with_listing():
+    item_cache = Office365ItemCache(max_size=10, time_to_live=60)
+    item_cache.put("/root/folder", {"id": "folder", "name": "folder", "folder": {}})
+    item_cache.put_children("/root/folder", [{"id": "a", "name": "a.txt"}, {"id": "b", "name": "b.txt"}])
+    return item_cache
+
+
+def test_listed_folders_are_served_by_id():
+    item_cache = get_cache_with_listing()
+    assert [child.get("id") for child in item_cache.get_children_by_id("folder")] == ["a", "b"]
+    assert item_cache.get_by_id("b") == {"id": "b", "name": "b.txt"}
+
+
+def test_unlisted_folders_are_not_served():
+    item_cache = get_cache_with_listing()
+    item_cache.put("/root/other", {"id": "other", "name": "other", "folder": {}})
+    assert item_cache.get_children_by_id("other") is None
+    assert item_cache.get_children_by_id("unknown") is None
+
+
+def test_writing_in_a_folder_drops_its_listing():
+    item_cache = get_cache_with_listing()
+    item_cache.invalidate("/root/folder/c.txt")
+    assert item_cache.get_children_by_id("folder") is None
+
+
+def test_listing_is_dropped_when_a_child_is_evicted():
+    item_cache = get_cache_with_listing()
+    item_cache.max_size = 3
+    item_cache.put("/root/other.txt", {"id": "other", "name": "other.txt"})
+    assert item_cache.get_children_by_id("folder") is None
+
+
+def test_replaced_items_are_not_found_by_their_previous_id():
+    item_cache = get_cache_with_listing()
+    item_cache.put("/root/folder/a.txt", {"id": "new", "name": "a.txt"})
+    assert item_cache.get_by_id("a") is None
+    assert item_cache.get_by_id("new").get("id") == "new"
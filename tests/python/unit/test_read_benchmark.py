@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+
+PYTHON_LIB_PATH = os.path.join(os.path.dirname(__file__), "..", "..", "..", "python-lib")
+MB = 1024 * 1024
+FILE_SIZES_MB = [16, 64, 256]
+
+# Run in a fresh process for each file size, as peak RSS never goes down within a process.
+# A local server streams the file, generated on the fly, so that only the reading side uses memory.
+READ_SCRIPT = textwrap.dedent("""
+    import json, resource, sys, threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from office365_client import Office365Session
+
+    file_size, limit = int(sys.argv[1]), int(sys.argv[2])
+    block = b"x" * 1048576
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            size = file_size
+            if self.headers.get("Range"):
+                size = int(self.headers.get("Range").split("-")[1]) + 1
+                self.send_response(206)
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            while size > 0:
+                self.wfile.write(block[:size])
+                size -= len(block)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Sink(object):
+        def __init__(self):
+            self.size = 0
+
+        def write(self, data):
+            self.size += len(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    drive = Office365Session(access_token="token").get_drive("drive")
+    sink = Sink()
+    drive.read_file_content("http://127.0.0.1:{}/file".format(server.server_address[1]), sink, limit=limit or None)
+    server.shutdown()
+    print(json.dumps({"read": sink.size, "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+""")
+
+
+def read_in_subprocess(file_size, limit=0):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PYTHON_LIB_PATH, os.environ.get("PYTHONPATH", "")]))
+    output = subprocess.check_output([sys.executable, "-c", READ_SCRIPT, str(file_size), str(limit)], env=env)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def test_peak_rss_stays_flat_as_file_size_grows():
+    from benchmark_utils import report_benchmark
+    results = []
+    for file_size_mb in FILE_SIZES_MB:
+        result = read_in_subprocess(file_size_mb * MB)
+        assert result.get("read") == file_size_mb * MB
+        results.append((file_size_mb, result.get("peak_rss_kb") / 1024.0))
+    report_benchmark(
+        "read_file_content peak RSS",
+        ["{:>5} MB file: {:6.1f} MB peak RSS".format(file_size_mb, peak_rss_mb) for file_size_mb, peak_rss_mb in results]
+    )
+    smallest_peak_rss_mb = results[0][1]
+    largest_peak_rss_mb = results[-1][1]
+    # The file grows by 240 MB, the memory used to read it should not
+    assert largest_peak_rss_mb - smallest_peak_rss_mb < 32
+
+
+def test_limit_only_reads_the_first_bytes():
+    result = read_in_subprocess(64 * MB, limit=1000)
+    assert result.get("read") == 1000
@@ -0,0 +1,76 @@
+import time
+from benchmark_utils import report_benchmark
+from office365_row_mapper import Office365ReadRowMapper, Office365WriteRowMapper
+
+
+NUMBER_OF_ROWS = 50000
+
+SHAREPOINT_COLUMNS = [
+    {"name": "Title", "displayName": "Title", "text": {}},
+    {"name": "Price", "displayName": "Price", "number": {}},
+    {"name": "Quantity", "displayName": "Quantity", "number": {"decimalPlaces": "none"}},
+    {"name": "Done", "displayName": "Done", "boolean": {}},
+    {"name": "Due", "displayName": "Due date", "dateTime": {}},
+    {"name": "Owner", "displayName": "Owner", "personOrGroup": {}},
+    {"name": "Category", "displayName": "Category", "lookup": {"listId": "list"}},
+    {"name": "Tags", "displayName": "Tags", "lookup": {"listId": "list", "allowMultipleValues": True}},
+    {"name": "Link", "displayName": "Link", "hyperlinkOrPicture": {}}
+]
+
+SHAREPOINT_ROW = {
+    "id": "12",
+    "fields": {
+        "Title": "Item 12",
+        "Price": 12.5,
+        "Quantity": "3",
+        "Done": True,
+        "Due": "2024-01-01T00:00:00Z",
+        "OwnerLookupId": "7",
+        "CategoryLookupId": "4",
+        "Tags": [{"LookupId": 1, "LookupValue": "a"}, {"LookupId": 2, "LookupValue": "b"}],
+        "Link": {"Url": "https://example.com", "Description": "Example"},
+        "@odata.etag": "\"etag,1\"",
+        "ContentType": "Item"
+    }
+}
+
+DSS_COLUMNS = [
+    {"name": "Title", "type": "string"},
+    {"name": "Price", "type": "double"},
+    {"name": "Quantity", "type": "bigint"},
+    {"name": "Done", "type": "boolean"},
+    {"name": "Due date", "type": "date"},
+    {"name": "Owner", "type": "string"},
+    {"name": "Category", "type": "string"},
+    {"name": "Tags", "type": "array"},
+    {"name": "Link", "type": "object"}
+]
+
+DSS_ROW = ["Item 12", 12.5, 3, "true", "2024-01-01T00:00:00.000Z", "Owner", "Category", "[\"a\", \"b\"]", "{}"]
+
+
+def get_rows_per_second(map_row, row):
+    start = time.perf_counter()
+    for _ in range(NUMBER_OF_ROWS):
+        map_row(row)
+    return NUMBER_OF_ROWS / (time.perf_counter() - start)
+
+
+def test_row_mappers_throughput():
+    read_row_mapper = Office365ReadRowMapper(SHAREPOINT_COLUMNS)
+    write_row_mapper = Office365WriteRowMapper(DSS_COLUMNS)
+    assert read_row_mapper.map_row(SHAREPOINT_ROW).get("Tags") is not None
+    assert write_row_mapper.map_row(DSS_ROW).get("Quantity") == 3
+
+    read_rows_per_second = get_rows_per_second(read_row_mapper.map_row, SHAREPOINT_ROW)
+    write_rows_per_second = get_rows_per_second(write_row_mapper.map_row, DSS_ROW)
+    report_benchmark(
+        "row mappers throughput ({} columns, {} rows)".format(len(DSS_COLUMNS), NUMBER_OF_ROWS),
+        [
+            "Office365ReadRowMapper: {:10.0f} rows/s".format(read_rows_per_second),
+            "Office365WriteRowMapper: {:9.0f} rows/s".format(write_rows_per_second)
+        ]
+    )
+    # Loose floor, well under what the precompiled mappers reach, to catch large regressions only
+    assert read_rows_per_second > 20000
+    assert write_rows_per_second > 20000